@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional
+
+
+class LRUCache:
+    """A least-recently-used cache bounded by the total size of its values.
+
+    ``sizeof`` is called once per value to find how much of ``max_size`` it
+    takes up; by default this is ``len``, which suits ``bytes`` values.
+    ``get`` and ``set`` are safe to call from executor threads, whereas
+    ``get_or_fetch`` must only be awaited on the event loop.
+    """
+
+    def __init__(self, max_size: int, *, sizeof: Callable[[Any], int] = len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._sizes.pop(key)
+                del self._entries[key]
+
+            if size > self.max_size:
+                # This would evict everything else and then still not fit
+                return
+
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.size += size
+
+            while self.size > self.max_size:
+                old_key, _ = self._entries.popitem(last=False)
+                self.size -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            self.size -= self._sizes.pop(key)
+            return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.size = 0
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the value for ``key``, awaiting ``fetch()`` to create it on a miss.
+
+        Concurrent misses for the same key share a single call to ``fetch``.
+        Failures are not cached; every waiter receives the same exception.
+        """
+
+        while True:
+            value = self.get(key, _missing)
+            if value is not _missing:
+                return value
+
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    # We were cancelled ourselves
+                    raise
+                # The task that was fetching this key was cancelled, so one
+                # of its waiters needs to take over
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await fetch()
+        except Exception as exc:
+            future.set_exception(exc)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._pending[key]
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'coalesced': self.coalesced,
+        }
+
+
+_missing = object()
+
+
+class BufferPool:
+    """Keeps released buffers so that they can be reused instead of reallocated.
+
+    Buffers are grouped by key, e.g. by image size, and ``factory(key)``
+    creates a new one whenever none is free. Released buffers are dropped
+    rather than kept once the pool already holds ``max_size`` bytes of them,
+    as measured by ``sizeof``. A buffer's contents are left as they were when
+    it was released, so callers must reset what they need to.
+    """
+
+    def __init__(self, factory: Callable[[Hashable], Any], max_size: int, *, sizeof: Callable[[Any], int]):
+        self.factory = factory
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+        self._free: Dict[Hashable, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Hashable) -> Any:
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                buffer = free.pop()
+                self.size -= self.sizeof(buffer)
+                self.reused += 1
+                return buffer
+
+            self.created += 1
+
+        return self.factory(key)
+
+    def release(self, key: Hashable, buffer: Any) -> None:
+        size = self.sizeof(buffer)
+        with self._lock:
+            if self.size + size > self.max_size:
+                self.discarded += 1
+                return
+
+            self._free.setdefault(key, []).append(buffer)
+            self.size += size
+
+    @contextmanager
+    def borrow(self, key: Hashable) -> Iterator[Any]:
+        buffer = self.acquire(key)
+        try:
+            yield buffer
+        finally:
+            self.release(key, buffer)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pooled': sum(len(free) for free in self._free.values()),
+            'size': self.size,
+            'max_size': self.max_size,
+            'created': self.created,
+            'reused': self.reused,
+            'discarded': self.discarded,
+        }
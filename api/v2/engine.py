@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import render
+from .layers import LayerData
+
+
+def _run_shared(func: Callable[..., Any], name: str, spans: List[Tuple[int, int]], kwargs: Dict[str, Any]) -> Any:
+    # Runs in a worker process. The parent owns the shared memory block, so
+    # this only attaches to it and never unlinks it. Layers are decoded
+    # straight from views of the block rather than copied out of it
+    block = shared_memory.SharedMemory(name=name)
+    bytefiles = [block.buf[offset:offset + length] for offset, length in spans]
+    try:
+        return func(bytefiles, **kwargs)
+    finally:
+        # Views into the block have to be released before it can be closed
+        for view in bytefiles:
+            view.release()
+        block.close()
+
+
+def _started() -> None:
+    pass
+
+
+class CompositingEngine:
+    """Runs image work for the merge routes away from the event loop.
+
+    ``kind`` is either ``thread``, which uses a dedicated thread pool, or
+    ``process``, which uses a pool of worker processes so that merges are not
+    limited by the GIL. Layer data is handed to worker processes through one
+    shared memory block per merge instead of being pickled.
+
+    Worker processes are forked as soon as the engine is created, so it must
+    be created before anything else starts a thread; a thread's locks are
+    copied into every fork in whatever state they were in.
+    """
+
+    def __init__(
+        self,
+        kind: str = 'thread',
+        *,
+        workers: Optional[int] = None,
+        decoded_cache_size: int = 0,
+        prefix_cache_size: int = 0,
+    ):
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.failed = 0
+
+        self.executor: Executor
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='realtools-render')
+        elif kind == 'process':
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # web.py can't be imported again without starting another
+                # server, so workers must be forked rather than spawned
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=partial(
+                    render.configure,
+                    decoded_cache_size=decoded_cache_size,
+                    prefix_cache_size=prefix_cache_size,
+                ),
+            )
+        else:
+            raise ValueError(f'Unknown compositing engine {kind!r}. Must be one of thread, process.')
+
+        if kind == 'process':
+            # Workers have to share this process's resource tracker, or each
+            # of them starts its own, which then unlinks the shared memory
+            # blocks that the worker attached to once it exits
+            resource_tracker.ensure_running()
+            # Pools only fork workers once there's work for them, by which
+            # time the server has other threads. Every pending task that no
+            # worker has picked up yet makes the pool fork another one
+            started = [self.executor.submit(_started) for _ in range(self.workers)]
+            for future in started:
+                future.result()
+
+    async def run(self, func: Callable[..., Any], bytefiles: List[LayerData], **kwargs) -> Any:
+        """Call ``func(bytefiles, **kwargs)`` in the pool and return its result.
+
+        In a process pool, ``func`` must be a module-level function.
+        """
+
+        loop = asyncio.get_event_loop()
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            if self.kind == 'thread':
+                result = await loop.run_in_executor(self.executor, partial(func, bytefiles, **kwargs))
+            else:
+                result = await self._run_in_process(loop, func, bytefiles, kwargs)
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            return result
+        finally:
+            self.pending -= 1
+
+    async def _run_in_process(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        func: Callable[..., Any],
+        bytefiles: List[LayerData],
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        spans = []
+        offset = 0
+        for data in bytefiles:
+            spans.append((offset, len(data)))
+            offset += len(data)
+
+        # SharedMemory can't be created with a size of 0
+        block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        try:
+            for data, (start, length) in zip(bytefiles, spans):
+                block.buf[start:start + length] = data
+
+            return await loop.run_in_executor(
+                self.executor,
+                partial(_run_shared, func, block.name, spans, kwargs),
+            )
+        finally:
+            block.close()
+            block.unlink()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'kind': self.kind,
+            'workers': self.workers,
+            'pending': self.pending,
+            # Merges waiting for a free worker
+            'queued': max(self.pending - self.workers, 0),
+            'peak_pending': self.peak_pending,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,51 @@
+import logging
+import traceback
+
+import horsereality
+from sanic.exceptions import SanicException
+
+
+log = logging.getLogger('realtools')
+
+# This dict intentionally skips a number of error
+# codes that Realtools would never raise
+STATUS_MESSAGES = {
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+}
+
+
+def error_info(exception: BaseException) -> dict:
+    """Describe ``exception`` as the JSON body of an error response.
+
+    This is what the app's error handler responds with, and what
+    ``/merge/bulk`` reports for each horse that failed. Unexpected errors are
+    logged.
+    """
+
+    status_code = getattr(exception, 'status_code', getattr(exception, 'status', 500))
+    error_name = None
+    error_message = STATUS_MESSAGES.get(status_code, 'Internal Server Error')
+
+    if status_code == 500:
+        log.error(''.join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+
+    if isinstance(exception, horsereality.HorseRealityException):
+        error_message = exception.message
+
+    elif isinstance(exception, SanicException):
+        error_message = str(exception)
+        error_name = (exception.extra or {}).get('name')
+
+    return {'status': status_code, 'message': error_message, 'name': error_name}
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+
+log = logging.getLogger('realtools')
+
+LAYER_TABLES = ('color_layers', 'white_layers', 'testable_white_layers')
+# Tables with sheet blocks are read in sheet order, which is the order that
+# the queries the index replaces return them in
+LOAD_QUERIES = {
+    'color_layers': 'SELECT * FROM color_layers ORDER BY block, ordinal, id',
+    'white_layers': 'SELECT * FROM white_layers',
+    'testable_white_layers': 'SELECT * FROM testable_white_layers ORDER BY block, ordinal, id',
+}
+LAYER_ID_COLUMNS = ('stallion_id', 'mare_id', 'foal_id')
+INDEXED_COLUMNS = LAYER_ID_COLUMNS + ('color',)
+
+# Anything that changes the layer tables can run `NOTIFY realtools_layers` to
+# have every instance reload them straight away
+DEFAULT_CHANNEL = 'realtools_layers'
+
+
+class LayerTable:
+    """The rows of one layer table, indexed by ``(breed, value)`` for each of
+    ``INDEXED_COLUMNS`` that the table has.
+
+    Rows are kept in the order that the table was read in, and lookups return
+    them in that order, like the queries they replace. Tables with sheet
+    blocks are also indexed by ``(breed, block)``.
+    """
+
+    def __init__(self, rows: List[asyncpg.Record]):
+        self.rows = rows
+        self._indexes: Dict[str, Dict[Tuple[str, str], List[int]]] = {}
+        self._blocks: Dict[Tuple[str, int], List[asyncpg.Record]] = defaultdict(list)
+
+        columns = [column for column in INDEXED_COLUMNS if rows and column in rows[0].keys()]
+        for column in columns:
+            self._indexes[column] = defaultdict(list)
+        has_blocks = bool(rows) and 'block' in rows[0].keys()
+
+        for position, row in enumerate(rows):
+            for column in columns:
+                value = row[column]
+                if value is not None:
+                    self._indexes[column][(row['breed'], value)].append(position)
+            if has_blocks and row['block'] is not None:
+                self._blocks[(row['breed'], row['block'])].append(row)
+
+        for block in self._blocks.values():
+            block.sort(key=lambda row: row['ordinal'])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def find(self, breed: str, values: Iterable[Optional[str]], *, columns: Sequence[str] = ('foal_id',)) -> List[asyncpg.Record]:
+        """The rows of ``breed`` where any of ``columns`` is one of ``values``.
+
+        Like in SQL, None never matches anything.
+        """
+
+        positions = set()
+        for column in columns:
+            index = self._indexes.get(column, {})
+            for value in values:
+                positions.update(index.get((breed, value), ()))
+
+        return [self.rows[position] for position in sorted(positions)]
+
+    def block(self, breed: str, block: int) -> List[asyncpg.Record]:
+        """The rows of one sheet block, in sheet order."""
+        return self._blocks.get((breed, block), [])
+
+
+class LayerTables:
+    """One consistent copy of every layer table."""
+
+    def __init__(self, tables: Dict[str, List[asyncpg.Record]], version: int):
+        self.color_layers = LayerTable(tables['color_layers'])
+        self.white_layers = LayerTable(tables['white_layers'])
+        self.testable_white_layers = LayerTable(tables['testable_white_layers'])
+        self.version = version
+
+
+class LayerIndex:
+    """Keeps the layer tables in memory so that Realvision and color naming
+    don't have to query Postgres.
+
+    The tables only change when breed sheets are imported. They are read
+    again whenever a notification arrives on ``channel``, and every
+    ``refresh_interval`` seconds the table statistics are checked for changes
+    in case a notification was missed. Each reload builds a new
+    :class:`LayerTables` and replaces ``current`` with it in one step, so
+    readers never see a half loaded copy. ``current`` is None until the
+    tables have been loaded once, in which case callers should query Postgres
+    themselves.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, *, channel: str = DEFAULT_CHANNEL, refresh_interval: float = 300):
+        self.pool = pool
+        self.channel = channel
+        self.refresh_interval = refresh_interval
+        self.current: Optional[LayerTables] = None
+
+        self.loads = 0
+        self.load_failures = 0
+        self.notifications = 0
+        self.loaded_at: Optional[float] = None
+
+        self._listener: Optional[asyncpg.Connection] = None
+        self._refreshing: Optional[asyncio.Future] = None
+        self._stale = False
+        self._poller: Optional[asyncio.Task] = None
+
+    async def _fetch_version(self, connection: asyncpg.Connection) -> int:
+        # These counters go up with every write to the tables, which is
+        # enough to tell whether they need to be read again. Estimates like
+        # n_live_tup are left out, since ANALYZE and autovacuum change them
+        # without the data changing
+        return await connection.fetchval(
+            '''
+            SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)::bigint
+            FROM pg_stat_user_tables
+            WHERE relname = ANY($1::text[])
+            ''',
+            list(LAYER_TABLES)
+        )
+
+    async def load(self) -> None:
+        """Read every layer table and replace ``current`` with them."""
+
+        async with self.pool.acquire() as connection:
+            async with connection.transaction(isolation='repeatable_read', readonly=True):
+                # Read before the tables so that a change made while they are
+                # being read makes the next check reload them
+                version = await self._fetch_version(connection)
+                tables = {table: await connection.fetch(LOAD_QUERIES[table]) for table in LAYER_TABLES}
+
+        # Indexing a large table takes a moment, so keep it off the event loop
+        self.current = await asyncio.get_event_loop().run_in_executor(None, LayerTables, tables, version)
+        self.loads += 1
+        self.loaded_at = time.time()
+        log.info(
+            f'Loaded layer index version {version}: '
+            + ', '.join(f'{len(rows)} {table}' for table, rows in tables.items())
+        )
+
+    async def _refresh(self) -> None:
+        while True:
+            self._stale = False
+            try:
+                await self.load()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+                self.load_failures += 1
+                log.warning(f'Failed to load the layer index: {exc}')
+                return
+
+            if not self._stale:
+                return
+
+    def refresh(self) -> asyncio.Future:
+        """Reload the tables in the background.
+
+        Refreshes that are asked for while one is already running are done
+        once, after it.
+        """
+
+        if self._refreshing is not None and not self._refreshing.done():
+            self._stale = True
+        else:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        return self._refreshing
+
+    def _notified(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        self.notifications += 1
+        self.refresh()
+
+    async def _listen(self) -> None:
+        if self._listener is not None:
+            if not self._listener.is_closed():
+                return
+            await self.pool.release(self._listener)
+            self._listener = None
+
+        connection = await self.pool.acquire()
+        try:
+            await connection.add_listener(self.channel, self._notified)
+        except BaseException:
+            await self.pool.release(connection)
+            raise
+        self._listener = connection
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                # The listening connection may have been lost since the last
+                # check, along with any notifications sent to it
+                await self._listen()
+                async with self.pool.acquire() as connection:
+                    version = await self._fetch_version(connection)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+                log.warning(f'Failed to check the layer index for changes: {exc}')
+                continue
+
+            if self.current is None or version != self.current.version:
+                self.refresh()
+
+    async def start(self) -> None:
+        """Load the tables and start watching them for changes.
+
+        Failures are logged rather than raised, and are retried on the next
+        check.
+        """
+
+        await self.refresh()
+        try:
+            await self._listen()
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+            log.warning(f'Failed to listen for layer index changes: {exc}')
+
+        if self.refresh_interval > 0:
+            self._poller = asyncio.ensure_future(self._poll())
+
+    async def close(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+        if self._listener is not None:
+            if not self._listener.is_closed():
+                await self._listener.remove_listener(self.channel, self._notified)
+            await self.pool.release(self._listener)
+            self._listener = None
+
+    def stats(self) -> Dict[str, Any]:
+        current = self.current
+        return {
+            'loaded': current is not None,
+            'version': current.version if current is not None else None,
+            'rows': {
+                table: len(getattr(current, table)) for table in LAYER_TABLES
+            } if current is not None else None,
+            'loads': self.loads,
+            'load_failures': self.load_failures,
+            'notifications': self.notifications,
+            'loaded_at': self.loaded_at,
+            'listening': self._listener is not None and not self._listener.is_closed(),
+        }
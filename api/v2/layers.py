@@ -0,0 +1,328 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from functools import partial
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Union
+
+import horsereality
+
+from .cache import LRUCache
+
+
+log = logging.getLogger('realtools')
+
+# Layer data is either the bytes read from Horse Reality or a read-only map of
+# a file in the LayerStore. Worker processes see it as a view of the shared
+# memory that it was handed over in. Any of them can be passed to `len` and
+# `render.decode_layer`
+LayerData = Union[bytes, mmap.mmap, memoryview]
+
+
+class LayerFetchError(Exception):
+    """Raised when one layer of a batch could not be read.
+
+    ``position`` is the index of the layer in the list that was passed to
+    :meth:`LayerFetcher.read_many`, and ``original`` is the exception raised
+    by ``horsereality``.
+    """
+
+    def __init__(self, position: int, layer: horsereality.Layer, original: Exception):
+        super().__init__(f'Failed to read layer at position {position}: {layer.url_path}')
+        self.position = position
+        self.layer = layer
+        self.original = original
+
+
+class LayerStore:
+    """Keeps layer images in a directory so that they survive restarts.
+
+    Files are named after a hash of the layer's URL path, written atomically,
+    and evicted least recently used first once the directory grows past
+    ``max_size`` bytes. Reading a file touches its modification time, which
+    is what the order is rebuilt from after a restart.
+    Reads return a read-only memory map of the file rather than its bytes.
+    Every map holds a file descriptor open until it is garbage collected, so
+    once ``max_maps`` of them are alive, files are read into memory instead.
+    """
+
+    def __init__(self, path: str, max_size: int, *, max_maps: int = 256):
+        self.path = path
+        self.max_size = max_size
+        self.max_maps = max_maps
+        self.size = 0
+        self.mapped = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unmapped_reads = 0
+
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        files = []
+        for directory, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                if filename.startswith('.tmp'):
+                    # Left over from a write that never finished
+                    os.remove(file_path)
+                    continue
+                stat = os.stat(file_path)
+                files.append((stat.st_mtime, file_path, stat.st_size))
+
+        for _, file_path, size in sorted(files):
+            self._entries[file_path] = size
+            self.size += size
+
+        self._evict()
+        log.info(f'Loaded {len(self._entries)} layers ({self.size} bytes) from {self.path}')
+
+    def _file_path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], f'{digest}.png')
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and self._entries:
+            file_path, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def _unmapped(self) -> None:
+        with self._lock:
+            self.mapped -= 1
+
+    def _read_file(self, fp) -> Optional[LayerData]:
+        if os.fstat(fp.fileno()).st_size == 0:
+            # Empty files can't be mapped, and are never valid layers anyway
+            return None
+
+        with self._lock:
+            can_map = self.mapped < self.max_maps
+            if can_map:
+                self.mapped += 1
+
+        if not can_map:
+            self.unmapped_reads += 1
+            return fp.read()
+
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._unmapped()
+            raise
+        weakref.finalize(data, self._unmapped)
+        return data
+
+    def open(self, key: str) -> Optional[LayerData]:
+        """Return the stored data for ``key``, or None if there isn't any.
+
+        This does blocking file I/O, so call it from an executor.
+        """
+
+        file_path = self._file_path(key)
+        try:
+            with open(file_path, 'rb') as fp:
+                data = self._read_file(fp)
+        except OSError as exc:
+            # Besides missing files, this can be running out of file
+            # descriptors. Either way the layer can still be read from Horse
+            # Reality
+            if not isinstance(exc, FileNotFoundError):
+                log.warning(f'Failed to open stored layer {key}: {exc}')
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(file_path)
+        except OSError:
+            # Only the eviction order after a restart depends on this
+            pass
+
+        with self._lock:
+            if file_path in self._entries:
+                self._entries.move_to_end(file_path)
+            self.hits += 1
+        return data
+
+    def write(self, key: str, data: bytes) -> None:
+        file_path = self._file_path(key)
+        directory = os.path.dirname(file_path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self.size -= self._entries.pop(file_path, 0)
+            self._entries[file_path] = len(data)
+            self.size += len(data)
+            self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'mapped': self.mapped,
+            'max_maps': self.max_maps,
+            'unmapped_reads': self.unmapped_reads,
+        }
+
+
+class LayerFetcher:
+    """Reads layer images on behalf of the merge routes.
+
+    Every request shares one global semaphore so that a burst of merges cannot
+    open an unbounded number of connections to Horse Reality, and each batch
+    is additionally capped by ``request_concurrency`` so that one very large
+    request cannot take every global slot for itself.
+
+    Layer images never change once they are uploaded, so when ``cache`` is
+    given their data is kept in it by URL path and shared between requests.
+    ``store`` is checked after ``cache`` and is written to whenever a layer
+    has to be read from Horse Reality. Layers found in ``store`` are not
+    copied into ``cache``; the OS page cache already keeps hot files mapped.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = 32,
+        request_concurrency: int = 8,
+        cache: Optional[LRUCache] = None,
+        store: Optional[LayerStore] = None,
+    ):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.request_concurrency = request_concurrency
+        self.cache = cache
+        self.store = store
+
+    def _write_to_store(self, key: str, data: bytes) -> None:
+        try:
+            self.store.write(key, data)
+        except OSError as exc:
+            log.warning(f'Failed to store layer {key}: {exc}')
+
+    async def _fetch(self, layer: horsereality.Layer, request_semaphore: asyncio.Semaphore) -> bytes:
+        async with request_semaphore, self.semaphore:
+            data = await layer.read()
+
+        if self.store is not None:
+            # No need to hold up the response for this
+            asyncio.get_event_loop().run_in_executor(None, self._write_to_store, layer.url_path, data)
+
+        return data
+
+    async def read(
+        self,
+        layer: horsereality.Layer,
+        *,
+        request_semaphore: Optional[asyncio.Semaphore] = None,
+        request_cache: Optional[LRUCache] = None,
+    ) -> LayerData:
+        """Read a single layer, using the cache and store if there are any.
+
+        Only reads that actually go to Horse Reality count against the
+        concurrency limits. ``request_cache`` is checked before anything
+        else, so that a request that reads the same layer several times only
+        reads it once even when ``cache`` is disabled.
+        """
+
+        key = layer.url_path
+        if request_cache is not None:
+            return await request_cache.get_or_fetch(
+                key,
+                partial(self.read, layer, request_semaphore=request_semaphore),
+            )
+
+        if self.cache is not None and key in self.cache:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+        if self.store is not None:
+            data = await asyncio.get_event_loop().run_in_executor(None, self.store.open, key)
+            if data is not None:
+                return data
+
+        if request_semaphore is None:
+            request_semaphore = asyncio.Semaphore(self.request_concurrency)
+
+        fetch = partial(self._fetch, layer, request_semaphore)
+        if self.cache is None:
+            return await fetch()
+
+        return await self.cache.get_or_fetch(key, fetch)
+
+    async def read_many(
+        self,
+        layers: List[horsereality.Layer],
+        *,
+        request_semaphore: Optional[asyncio.Semaphore] = None,
+        request_cache: Optional[LRUCache] = None,
+    ) -> List[LayerData]:
+        """Read all of ``layers`` concurrently, returning their data in the same order.
+
+        Batches that belong to the same request can share ``request_semaphore``
+        so that they are limited to ``request_concurrency`` between them, and
+        ``request_cache`` so that layers they have in common are read once.
+        """
+
+        if request_semaphore is None:
+            request_semaphore = asyncio.Semaphore(self.request_concurrency)
+
+        async def read(position: int, layer: horsereality.Layer) -> LayerData:
+            try:
+                return await self.read(layer, request_semaphore=request_semaphore, request_cache=request_cache)
+            except horsereality.HTTPException as exc:
+                raise LayerFetchError(position, layer, exc) from exc
+
+        tasks = [asyncio.ensure_future(read(position, layer)) for position, layer in enumerate(layers)]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            # Don't leave the rest of the batch running once the result is
+            # already known to be unusable
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'store': self.store.stats() if self.store is not None else None,
+        }
@@ -2,11 +2,11 @@ import asyncio
 import base64
 import datetime
 from dataclasses import asdict, dataclass
-from functools import partial
-from io import BytesIO
+import hashlib
 import json
-import random
-from typing import List, Optional, Union
+import logging
+import math
+from typing import Dict, List, Optional, Tuple, Union
 import traceback
 from urllib.parse import urlunparse
 
@@ -18,62 +18,320 @@ from sanic.exceptions import InvalidUsage, NotFound, ServerError
 
 import horsereality
 
+from .cache import LRUCache
+from .engine import CompositingEngine
+from .errors import error_info
+from .layers import LayerData, LayerFetchError, LayerFetcher
+from .render import (
+    DecodedLayer,
+    Encoding,
+    add_horse_reality_logo,
+    cache_prefixes,
+    cached_prefix,
+    composite,
+    contact_sheet,
+    decode_layer,
+    encode_image,
+    image_canvases,
+    make_thumbnail,
+    prefix_keys,
+    supported_formats,
+    watermarked_size,
+)
+from .shares import (
+    ID_PATTERN as SHARE_ID_PATTERN,
+    SHARE_TTL,
+    ShareCache,
+    ShareStore,
+    canonicalize,
+    decode_share,
+    encode_share,
+    share_id,
+    share_key,
+)
 from .utils import name_color
 
 
 api = sanic.Blueprint('Merge-v2')
+log = logging.getLogger('realtools')
 
 
-def add_horse_reality_logo(image, *, left=False):
-    logo = Image.open('static/horse-reality-logo-small.png')
+def decode_layers(
+    bytefiles: List[LayerData],
+    keys: Optional[List[str]] = None,
+    size: Optional[Tuple[int, int]] = None,
+) -> List[DecodedLayer]:
+    # `keys` are the layers' URL paths, which lets decoded layers be reused
+    # between merges
+    if keys is None:
+        keys = [None] * len(bytefiles)
 
-    original_canvas = Image.new('RGBA', (image.width, image.height + logo.height))
-    original_canvas.paste(image, (0, logo.height))
+    images = []
+    for file, key in zip(bytefiles, keys):
+        # The first layer decides the size of the canvas, unless the caller
+        # already knows it
+        images.append(decode_layer(file, size, key=key))
+        size = images[0].size
 
-    logo_canvas = Image.new('RGBA', original_canvas.size)
-    if left:
-        logo_canvas.paste(logo, (0, 0))  # top left
-    else:
-        logo_canvas.paste(logo, (original_canvas.width - logo.width, 0))  # top right
+    return images
+
+
+def pil_process(
+    bytefiles: List[LayerData],
+    *,
+    keys: Optional[List[str]] = None,
+    use_watermark=True,
+    left_watermark=False,
+    encoding: Encoding = Encoding(),
+    use_prefix_cache=False,
+):
+    if not bytefiles:
+        raise ValueError('No images.')
 
-    new_image = Image.alpha_composite(original_canvas, logo_canvas)
-    return new_image
+    base = on_layer = None
+    start = 0
+    if use_prefix_cache and keys is not None:
+        # Only the layers after the longest prefix that has been composited
+        # before need to be decoded and composited again
+        prefixes = prefix_keys(keys)
+        start, base = cached_prefix(prefixes)
+        on_layer = cache_prefixes(prefixes, start)
 
+    images = decode_layers(
+        bytefiles[start:],
+        keys[start:] if keys is not None else None,
+        base.size if base is not None else None,
+    )
 
-def pil_process(bytefiles: List[bytes], *, use_watermark=True, left_watermark=False):
-    new_image = None
-    for file in bytefiles:
-        image = Image.open(BytesIO(file), formats=('PNG',))
-        if new_image is None:
-            # dynamically create a new image per horse because each horse's
-            # resolution is apparently just a little different
-            new_image = Image.new('RGBA', image.size)
+    # Everything below draws on pooled canvases, and only the encoded bytes
+    # outlive them
+    with composite(images, base=base, on_layer=on_layer) as new_image:
+        if use_watermark is not True:
+            return encode_image(new_image, encoding)
 
-        if new_image.size != image.size:
-            # sometimes images will not be the same resolution, which causes
-            # Pillow to complain. luckily we can just resize to the previous
-            # image's size without really any issues
-            image = image.resize(new_image.size)
+        with image_canvases.borrow(watermarked_size(new_image.size)) as canvas:
+            new_image = add_horse_reality_logo(new_image, left=left_watermark, canvas=canvas)
+            return encode_image(new_image, encoding)
 
-        if image.mode != 'RGBA':
-            # sometimes images are opened in LA mode, which causes them
-            # to not be merge-able
-            image = image.convert('RGBA')
 
-        new_image = Image.alpha_composite(new_image, image)
+def sheet_process(
+    bytefiles: List[LayerData],
+    *,
+    counts: List[int],
+    keys: Optional[List[str]] = None,
+    columns: int,
+    cell_size: int,
+    use_watermark=True,
+    left_watermark=False,
+    encoding: Encoding = Encoding(),
+):
+    # `bytefiles` holds every cell's layers one after another, and `counts`
+    # says how many of them belong to each cell
+    if keys is None:
+        keys = [None] * len(bytefiles)
 
-    if new_image is None:
-        raise ValueError('No images.')
+    thumbnails = []
+    offset = 0
+    for count in counts:
+        if not count:
+            raise ValueError('No images.')
+        images = decode_layers(bytefiles[offset:offset + count], keys[offset:offset + count])
+        offset += count
+        with composite(images) as new_image:
+            thumbnails.append(make_thumbnail(new_image, cell_size))
 
+    sheet = contact_sheet(thumbnails, columns=columns, cell_size=cell_size)
     if use_watermark is True:
-        new_image = add_horse_reality_logo(new_image, left=left_watermark)
+        # Once for the whole sheet rather than once per horse
+        sheet = add_horse_reality_logo(sheet, left=left_watermark)
+
+    return encode_image(sheet, encoding)
+
+
+def data_uri(data: bytes, mimetype: str = 'image/png') -> str:
+    b64_str = base64.b64encode(data).decode('ascii')
+    return f'data:{mimetype};base64,{b64_str}'
+
+
+def merge_key(layers: List[horsereality.Layer], **options) -> str:
+    """Return a key that identifies the result of merging ``layers`` with ``options``.
+
+    Layer images never change, so the same layers in the same order with the
+    same options always produce the same image.
+    """
+
+    digest = hashlib.sha256()
+    for layer in layers:
+        digest.update(layer.url_path.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def with_etag(request: sanic.Request, response: sanic.HTTPResponse) -> sanic.HTTPResponse:
+    """Give ``response`` a strong ETag of its body.
+
+    If the client sent the same tag in If-None-Match, an empty 304 is returned
+    instead. The merge routes are POSTs, but they have no side effects, so
+    they answer conditional requests the same way a GET would. Binary
+    responses can carry color info in a header, so that is part of the tag
+    too.
+    """
+
+    digest = hashlib.blake2b(response.body, digest_size=20)
+    color_info = response.headers.get('X-Color-Info')
+    if color_info is not None:
+        digest.update(color_info.encode('ascii'))
+    etag = '"' + digest.hexdigest() + '"'
+    response.headers['ETag'] = etag
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if etag in tags or '*' in tags:
+            return r.empty(status=304, headers={'ETag': etag, **request.app.ctx.cors_headers(request)})
+
+    return response
+
+
+def response_format(request: sanic.Request, requested: Optional[str]) -> str:
+    """Decide between a JSON response and a raw image response.
+
+    Clients that don't ask for either explicitly get the raw image if their
+    Accept header asks for an image but not JSON.
+    """
+
+    if requested is None:
+        accept = request.headers.get('Accept', '')
+        if 'image/' in accept and 'application/json' not in accept:
+            return 'binary'
+        return 'json'
+
+    if requested not in ('json', 'binary'):
+        raise InvalidUsage('Invalid format. Must be one of json, binary.', extra={'name': 'format_invalid'})
+
+    return requested
+
+
+def output_encoding(request: sanic.Request, payload: dict) -> Encoding:
+    """Build the Encoding asked for by ``payload``'s image options.
+
+    Without an explicit ``image_format``, the best format in the Accept header
+    that this instance can write is used, falling back to PNG.
+    """
+
+    image_format: Optional[str] = payload.get('image_format')
+    if image_format is None:
+        accept = request.headers.get('Accept', '')
+        supported = supported_formats()
+        image_format = next(
+            (name for name in ('avif', 'webp') if f'image/{name}' in accept and name in supported),
+            'png',
+        )
+
+    try:
+        return Encoding(
+            format=image_format,
+            quality=payload.get('quality'),
+            preset=payload.get('preset') or 'balanced',
+        )
+    except ValueError as exc:
+        raise InvalidUsage(str(exc), extra={'name': 'encoding_invalid'})
+
+
+def horse_layers_for(horse: horsereality.Horse, *, use_whites: bool) -> Dict[str, List[horsereality.Layer]]:
+    should_use = lambda layer: not (layer.type is horsereality.LayerType.whites and not use_whites)
+    return {
+        'adult': [layer for layer in horse.adult_layers if should_use(layer)],
+        'foal': [layer for layer in horse.foal_layers if should_use(layer)],
+    }
+
+
+async def render_horse(
+    app: sanic.Sanic,
+    horse_layers: Dict[str, List[horsereality.Layer]],
+    *,
+    use_watermark: bool,
+    encoding: Encoding,
+    request_semaphore: Optional[asyncio.Semaphore] = None,
+    request_cache: Optional[LRUCache] = None,
+) -> Dict[str, Optional[bytes]]:
+    """Merge each of ``horse_layers``, keyed by adult and foal.
+
+    Sides without any layers are merged to None. ``request_semaphore`` and
+    ``request_cache`` are passed on to :meth:`LayerFetcher.read_many`.
+    """
+
+    results: Optional[LRUCache] = app.ctx.merge_results
+    result_keys = {
+        key: merge_key(layers, use_watermark=use_watermark, left_watermark=key == 'foal', encoding=asdict(encoding))
+        for key, layers in horse_layers.items()
+    }
+
+    merged = {key: None for key in horse_layers}
+    if results is not None:
+        for key, layers in horse_layers.items():
+            if layers:
+                merged[key] = results.get(result_keys[key])
+
+    to_render = [key for key, layers in horse_layers.items() if layers and merged[key] is None]
+    if not to_render:
+        return merged
+
+    async def render(key: str, bytes_layers_list: List[LayerData]) -> None:
+        engine: CompositingEngine = app.ctx.engine
+        try:
+            merged[key] = await engine.run(
+                pil_process,
+                bytes_layers_list,
+                keys=[layer.url_path for layer in horse_layers[key]],
+                use_watermark=use_watermark,
+                left_watermark=key == 'foal',
+                encoding=encoding,
+            )
+        except UnidentifiedImageError:
+            raise ServerError('Failed to get the right images.')
+        except:
+            raise ServerError('Failed to merge images.')
+
+        if results is not None:
+            results.set(result_keys[key], merged[key])
 
-    bio = BytesIO()
-    new_image.save(bio, format='PNG')
-    b64_str = base64.b64encode(bio.getvalue())
-    data_str_bytes = bytes('data:image/png;base64,', encoding='utf-8') + b64_str
-    data_str = data_str_bytes.decode(encoding='utf-8')
-    return data_str
+    # Layers for any images that weren't cached are read in one batch so
+    # that the whole horse only costs as much as its slowest layer
+    fetcher: LayerFetcher = app.ctx.layer_fetcher
+    try:
+        layer_data = await fetcher.read_many(
+            [layer for key in to_render for layer in horse_layers[key]],
+            request_semaphore=request_semaphore,
+            request_cache=request_cache,
+        )
+    except LayerFetchError as exc:
+        raise exc.original
+
+    # The adult and foal are independent, so they are rendered side by side
+    jobs = []
+    offset = 0
+    for key in to_render:
+        jobs.append(render(key, layer_data[offset:offset + len(horse_layers[key])]))
+        offset += len(horse_layers[key])
+    await asyncio.gather(*jobs)
+
+    return merged
+
+
+async def describe_color(app: sanic.Sanic, horse: horsereality.Horse) -> dict:
+    try:
+        data = await name_color(app, horse.breed, horse.layers)
+    except:
+        traceback.print_exc()
+        data = {'errors': ['colors_failed']}
+    if data is None:
+        data = {'errors': ['colors_no_info_available']}
+
+    data.pop('_raw_testable_color', None)
+    return data
 
 
 @dataclass
@@ -83,6 +341,11 @@ class MergePayload:
     use_watermark: Optional[bool] = True
     return_color_info: Optional[bool] = False
     return_layers: Optional[bool] = False
+    format: Optional[str] = None
+    image: Optional[str] = None
+    image_format: Optional[str] = None
+    quality: Optional[int] = None
+    preset: Optional[str] = None
 
 
 @api.post('/merge')
@@ -118,7 +381,7 @@ async def merge_single(request: sanic.Request, body: MergePayload):
             type: boolean
         - name: return_color_info
           in: body
-          description: Whether to attempt to name the horse's color & genotype
+          description: "Whether to attempt to name the horse's color & genotype. When `format` is `binary`, this is returned as JSON in the `X-Color-Info` header"
           required: false
           default: false
           schema:
@@ -130,6 +393,37 @@ async def merge_single(request: sanic.Request, body: MergePayload):
           default: false
           schema:
             type: boolean
+        - name: format
+          in: body
+          description: "`json` for the merged images as data URIs alongside the horse's info, or `binary` for just one raw PNG. Defaults to `binary` if the Accept header asks for `image/png` and `json` otherwise"
+          required: false
+          schema:
+            type: string
+        - name: image
+          in: body
+          description: "Which image to return when `format` is `binary` - `adult` or `foal`. Defaults to the adult if there is one"
+          required: false
+          schema:
+            type: string
+        - name: image_format
+          in: body
+          description: "The format to encode images in - `png`, `webp`, or `avif` if this instance supports it. Defaults to the best of these in the Accept header, or `png`"
+          required: false
+          schema:
+            type: string
+        - name: quality
+          in: body
+          description: "Quality from 0 to 100 for `webp` and `avif` images. Leaving this out for `webp` produces a lossless image"
+          required: false
+          schema:
+            type: integer
+        - name: preset
+          in: body
+          description: "`fast`, `balanced` or `small`, trading encoding time for size"
+          required: false
+          default: balanced
+          schema:
+            type: string
     responses:
         '200':
             description: The merged horse.
@@ -141,36 +435,48 @@ async def merge_single(request: sanic.Request, body: MergePayload):
     use_watermark: bool = payload['use_watermark']
     return_color_info: bool = payload['return_color_info']
     return_layers: bool = payload['return_layers']
+    format: str = response_format(request, payload['format'])
+    image: Optional[str] = payload['image']
+    encoding: Encoding = output_encoding(request, payload)
 
     if lifenumber < 1:
         raise InvalidUsage('Invalid lifenumber.')
 
+    if image not in (None, 'adult', 'foal'):
+        raise InvalidUsage('Invalid image. Must be one of adult, foal.', extra={'name': 'image_invalid'})
+
     hr: horsereality.Client = request.app.ctx.hr
     horse: horsereality.Horse = await hr.get_horse(lifenumber)
 
-    should_use = lambda layer: not (layer.type is horsereality.LayerType.whites and not use_whites)
-    bytefiles = {
-        'adult': [await layer.read() for layer in horse.adult_layers if should_use(layer)],
-        'foal': [await layer.read() for layer in horse.foal_layers if should_use(layer)],
-    }
+    horse_layers = horse_layers_for(horse, use_whites=use_whites)
 
-    image_data = {}
-    loop = asyncio.get_event_loop()
-    for key, bytes_layers_list in bytefiles.items():
-        if not bytes_layers_list:
-            image_data[key] = None
-            continue
-        try:
-            image_data[key] = await loop.run_in_executor(None, partial(
-                pil_process,
-                bytes_layers_list,
-                use_watermark=use_watermark,
-                left_watermark=key == 'foal',
-            ))
-        except UnidentifiedImageError:
-            raise ServerError('Failed to get the right images.')
-        except:
-            raise ServerError('Failed to merge images.')
+    if format == 'binary':
+        # Only one image fits in the response, so don't render the other
+        image = image or ('adult' if horse_layers['adult'] else 'foal')
+        if not horse_layers[image]:
+            raise NotFound(f'This horse has no {image} layers.', extra={'name': 'no_layers'})
+        horse_layers = {image: horse_layers[image]}
+
+    render_all = render_horse(request.app, horse_layers, use_watermark=use_watermark, encoding=encoding)
+    if return_color_info:
+        # Color naming only needs the database, so it runs while the images are being rendered
+        merged, color_info = await asyncio.gather(render_all, describe_color(request.app, horse))
+    else:
+        merged = await render_all
+
+    if format == 'binary':
+        headers = {
+            'X-Horse-Lifenumber': str(horse.lifenumber),
+            'X-Merged-Image': image,
+            **request.app.ctx.cors_headers(request),
+        }
+        if return_color_info:
+            # There's no body to put it in. json.dumps escapes anything that
+            # isn't ASCII, so this is always a valid header value
+            headers['X-Color-Info'] = json.dumps(color_info, separators=(',', ':'))
+        return with_etag(request, r.raw(merged[image], content_type=encoding.mimetype, headers=headers))
+
+    image_data = {key: data_uri(merged[key], encoding.mimetype) if merged[key] else None for key in horse_layers}
 
     horse_data = horse.to_dict()
 
@@ -183,28 +489,246 @@ async def merge_single(request: sanic.Request, body: MergePayload):
     }
 
     if return_color_info:
-        try:
-            data = await name_color(request.app, horse.breed, horse.layers)
-        except:
-            traceback.print_exc()
-            data = {'errors': ['colors_failed']}
-        if data is None:
-            data = {'errors': ['colors_no_info_available']}
+        return_payload['color_info'] = color_info
 
-        data.pop('_raw_testable_color', None)
-        return_payload['color_info'] = data
-
-    return r.json(
+    return with_etag(request, r.json(
         return_payload,
         status=200,
         headers=request.app.ctx.cors_headers(request),
+    ))
+
+
+# The most horses that can be merged in a single bulk request
+BULK_MAX_HORSES = 100
+# How many bytes of layers each bulk request keeps for its other horses.
+# Horses in one request tend to share most of their layers, so this only
+# needs to hold a few horses' worth of distinct ones
+BULK_LAYER_CACHE_SIZE = 128 * 1024 * 1024
+
+
+@dataclass
+class MergeBulkPayload:
+    lifenumbers: List[int]
+    use_whites: Optional[bool] = True
+    use_watermark: Optional[bool] = True
+    return_color_info: Optional[bool] = False
+    return_layers: Optional[bool] = False
+    image_format: Optional[str] = None
+    quality: Optional[int] = None
+    preset: Optional[str] = None
+
+
+@api.post('/merge/bulk')
+@validate(json=MergeBulkPayload)
+async def merge_bulk(request: sanic.Request, body: MergeBulkPayload):
+    """Merge Horses in Bulk
+
+    Combine the layers of several horses by their lifenumbers. Results are
+    streamed as newline-delimited JSON in the order that they finish, one
+    object per horse with its `lifenumber` and either the same data as the
+    single merge route or an `error`.
+
+    openapi:
+    ---
+    parameters:
+        - name: lifenumbers
+          in: body
+          description: The lifenumbers of the horses, at most 100
+          required: true
+          schema:
+            type: array
+            items:
+                type: integer
+        - name: use_whites
+          in: body
+          description: Whether to include white layers on the results
+          required: false
+          default: true
+          schema:
+            type: boolean
+        - name: use_watermark
+          in: body
+          description: Whether to include a watermark on the results
+          required: false
+          default: true
+          schema:
+            type: boolean
+        - name: return_color_info
+          in: body
+          description: Whether to attempt to name each horse's color & genotype
+          required: false
+          default: false
+          schema:
+            type: boolean
+        - name: return_layers
+          in: body
+          description: Whether to include `horse.layers`
+          required: false
+          default: false
+          schema:
+            type: boolean
+        - name: image_format
+          in: body
+          description: "The format to encode images in - `png`, `webp`, or `avif` if this instance supports it. Defaults to the best of these in the Accept header, or `png`"
+          required: false
+          schema:
+            type: string
+        - name: quality
+          in: body
+          description: "Quality from 0 to 100 for `webp` and `avif` images. Leaving this out for `webp` produces a lossless image"
+          required: false
+          schema:
+            type: integer
+        - name: preset
+          in: body
+          description: "`fast`, `balanced` or `small`, trading encoding time for size"
+          required: false
+          default: balanced
+          schema:
+            type: string
+    responses:
+        '200':
+            description: One line of JSON per horse.
+    """
+    payload: dict = asdict(body)
+
+    lifenumbers: List[int] = list(dict.fromkeys(payload['lifenumbers']))
+    use_whites: bool = payload['use_whites']
+    use_watermark: bool = payload['use_watermark']
+    return_color_info: bool = payload['return_color_info']
+    return_layers: bool = payload['return_layers']
+    encoding: Encoding = output_encoding(request, payload)
+
+    if not lifenumbers:
+        raise InvalidUsage('No lifenumbers passed.')
+    if len(lifenumbers) > BULK_MAX_HORSES:
+        raise InvalidUsage(f'Too many lifenumbers. The maximum is {BULK_MAX_HORSES}.', extra={'name': 'too_many_horses'})
+    if any(lifenumber < 1 for lifenumber in lifenumbers):
+        raise InvalidUsage('Invalid lifenumber.')
+
+    hr: horsereality.Client = request.app.ctx.hr
+    # Shared with every other bulk request, so that large batches queue up
+    # instead of each taking as many horses at once as they have
+    bulk_semaphore: asyncio.Semaphore = request.app.ctx.bulk_semaphore
+    request_semaphore = asyncio.Semaphore(request.app.ctx.layer_fetcher.request_concurrency)
+    # Layers that several horses have in common are only read once, whether
+    # or not the app has a layer cache
+    request_cache = LRUCache(BULK_LAYER_CACHE_SIZE)
+
+    async def merge_one(lifenumber: int) -> dict:
+        try:
+            async with bulk_semaphore:
+                horse: horsereality.Horse = await hr.get_horse(lifenumber)
+                render_all = render_horse(
+                    request.app,
+                    horse_layers_for(horse, use_whites=use_whites),
+                    use_watermark=use_watermark,
+                    encoding=encoding,
+                    request_semaphore=request_semaphore,
+                    request_cache=request_cache,
+                )
+                if return_color_info:
+                    merged, color_info = await asyncio.gather(render_all, describe_color(request.app, horse))
+                else:
+                    merged = await render_all
+        except Exception as exc:
+            return {'lifenumber': lifenumber, 'error': error_info(exc)}
+
+        horse_data = horse.to_dict()
+        if not return_layers:
+            horse_data.pop('layers')
+
+        item = {
+            'lifenumber': lifenumber,
+            'horse': horse_data,
+            'merged': {key: data_uri(data, encoding.mimetype) if data else None for key, data in merged.items()},
+        }
+        if return_color_info:
+            item['color_info'] = color_info
+        return item
+
+    response = await request.respond(
+        content_type='application/x-ndjson',
+        headers=request.app.ctx.cors_headers(request),
     )
 
+    tasks = [asyncio.ensure_future(merge_one(lifenumber)) for lifenumber in lifenumbers]
+    try:
+        for next_item in asyncio.as_completed(tasks):
+            await response.send(json.dumps(await next_item) + '\n')
+    finally:
+        # Nothing is left to send the rest to if the client went away
+        for task in tasks:
+            task.cancel()
+
+    await response.eof()
+
+
+def create_layers(hr: horsereality.Client, urls: List[str]) -> List[horsereality.Layer]:
+    try:
+        layers: List[horsereality.Layer] = []
+        for layer_url in urls:
+            if not layer_url.startswith('https://'):
+                # Accept bare keys like colours/foals/tail/large/id
+                layer_url = f'https://www.horsereality.com/upload/{layer_url}.png'
+            layers.append(hr.create_layer(layer_url))
+    except ValueError:
+        raise InvalidUsage('Invalid layer URL(s).', extra={'name': 'layers_invalid'})
+
+    return layers
+
+
+async def merge_layers(
+    app: sanic.Sanic,
+    layers: List[horsereality.Layer],
+    *,
+    use_watermark: bool,
+    encoding: Encoding,
+) -> bytes:
+    """Merge a stack of layers from the Multi tool, using the result cache if there is one."""
+
+    left_watermark = layers[0].horse_type == 'foals'
+
+    async def render() -> bytes:
+        fetcher: LayerFetcher = app.ctx.layer_fetcher
+        try:
+            bytefiles = await fetcher.read_many(layers)
+        except LayerFetchError as exc:
+            raise InvalidUsage(f'{exc.original.status} when fetching layer at position {exc.position}: {exc.layer.url_path}')
+
+        engine: CompositingEngine = app.ctx.engine
+        try:
+            return await engine.run(
+                pil_process,
+                bytefiles,
+                keys=[layer.url_path for layer in layers],
+                use_watermark=use_watermark,
+                left_watermark=left_watermark,
+                encoding=encoding,
+                # The Multi tool sends the same stack again every time one of
+                # its layers is toggled
+                use_prefix_cache=True,
+            )
+        except:
+            raise ServerError('Failed to merge images.')
+
+    results: Optional[LRUCache] = app.ctx.merge_results
+    if results is None:
+        return await render()
+
+    # Identical merges that are in progress at the same time are only rendered once
+    result_key = merge_key(layers, use_watermark=use_watermark, left_watermark=left_watermark, encoding=asdict(encoding))
+    return await results.get_or_fetch(result_key, render)
+
 
 @dataclass
 class MergeMultiPayload:
     urls: Union[List[str], str]  # Shortcut stringified variables
     use_watermark: Optional[bool] = True
+    format: Optional[str] = None
+    image_format: Optional[str] = None
+    quality: Optional[int] = None
+    preset: Optional[str] = None
 
 
 @api.post('/merge/multiple')
@@ -226,72 +750,371 @@ async def merge_multiple(request: sanic.Request, body: MergeMultiPayload):
     if not isinstance(use_watermark, bool):
         raise InvalidUsage('Invalid type for use_watermark.')
 
+    format: str = response_format(request, payload.get('format'))
+    encoding: Encoding = output_encoding(request, payload)
+
     hr: horsereality.Client = request.app.ctx.hr
 
-    try:
-        layers: List[horsereality.Layer] = []
-        for layer_url in urls:
-            if not layer_url.startswith('https://'):
-                # Accept bare keys like colours/foals/tail/large/id
-                layer_url = f'https://www.horsereality.com/upload/{layer_url}.png'
-            layers.append(hr.create_layer(layer_url))
-    except ValueError:
-        raise InvalidUsage('Invalid layer URL(s).', extra={'name': 'layers_invalid'})
+    layers = create_layers(hr, urls)
 
-    bytefiles = []
-    for layer in layers:
+    merged = await merge_layers(request.app, layers, use_watermark=use_watermark, encoding=encoding)
+
+    if format == 'binary':
+        return with_etag(request, r.raw(
+            merged,
+            content_type=encoding.mimetype,
+            headers=request.app.ctx.cors_headers(request),
+        ))
+
+    return with_etag(request, r.json(
+        {
+            'merged': data_uri(merged, encoding.mimetype),
+        },
+        status=200,
+        headers=request.app.ctx.cors_headers(request),
+    ))
+
+
+# Limits for /merge/sheet
+SHEET_MAX_CELLS = 100
+SHEET_MIN_CELL_SIZE = 16
+SHEET_MAX_CELL_SIZE = 512
+
+
+@dataclass
+class MergeSheetPayload:
+    lifenumbers: Optional[List[int]] = None
+    layers: Optional[List[List[str]]] = None
+    columns: Optional[int] = None
+    thumbnail_size: Optional[int] = 200
+    use_whites: Optional[bool] = True
+    use_watermark: Optional[bool] = True
+    image: Optional[str] = None
+    format: Optional[str] = None
+    image_format: Optional[str] = None
+    quality: Optional[int] = None
+    preset: Optional[str] = None
+
+
+@api.post('/merge/sheet')
+@validate(json=MergeSheetPayload)
+async def merge_sheet(request: sanic.Request, body: MergeSheetPayload):
+    """Merge Contact Sheet
+
+    Merge several horses or lists of layers and lay them out as thumbnails
+    in a single image.
+
+    openapi:
+    ---
+    parameters:
+        - name: lifenumbers
+          in: body
+          description: The lifenumbers of the horses to include. Either this or `layers` is required
+          required: false
+          schema:
+            type: array
+            items:
+                type: integer
+        - name: layers
+          in: body
+          description: Lists of layer URLs or keys to merge, in the same format as `/merge/multiple`
+          required: false
+          schema:
+            type: array
+            items:
+                type: array
+                items:
+                    type: string
+        - name: columns
+          in: body
+          description: How many thumbnails to put in each row. Defaults to as close to a square as possible
+          required: false
+          schema:
+            type: integer
+        - name: thumbnail_size
+          in: body
+          description: The width and height in pixels of each thumbnail's cell, from 16 to 512
+          required: false
+          default: 200
+          schema:
+            type: integer
+        - name: use_whites
+          in: body
+          description: Whether to include white layers on horses from `lifenumbers`
+          required: false
+          default: true
+          schema:
+            type: boolean
+        - name: use_watermark
+          in: body
+          description: Whether to include a watermark on the sheet
+          required: false
+          default: true
+          schema:
+            type: boolean
+        - name: image
+          in: body
+          description: "Which image of each horse from `lifenumbers` to use - `adult` or `foal`. Defaults to the adult if there is one"
+          required: false
+          schema:
+            type: string
+        - name: format
+          in: body
+          description: "`json` for the sheet as a data URI, or `binary` for the raw image. Defaults to `binary` if the Accept header asks for an image and `json` otherwise"
+          required: false
+          schema:
+            type: string
+        - name: image_format
+          in: body
+          description: "The format to encode the sheet in - `png`, `webp`, or `avif` if this instance supports it. Defaults to the best of these in the Accept header, or `png`"
+          required: false
+          schema:
+            type: string
+        - name: quality
+          in: body
+          description: "Quality from 0 to 100 for `webp` and `avif` images. Leaving this out for `webp` produces a lossless image"
+          required: false
+          schema:
+            type: integer
+        - name: preset
+          in: body
+          description: "`fast`, `balanced` or `small`, trading encoding time for size"
+          required: false
+          default: balanced
+          schema:
+            type: string
+    responses:
+        '200':
+            description: The contact sheet.
+    """
+    payload: dict = asdict(body)
+
+    lifenumbers: Optional[List[int]] = payload['lifenumbers']
+    layer_lists: Optional[List[List[str]]] = payload['layers']
+    columns: Optional[int] = payload['columns']
+    thumbnail_size: int = payload['thumbnail_size']
+    if thumbnail_size is None:
+        thumbnail_size = 200
+    use_whites: bool = payload['use_whites']
+    use_watermark: bool = payload['use_watermark']
+    image: Optional[str] = payload['image']
+    format: str = response_format(request, payload['format'])
+    encoding: Encoding = output_encoding(request, payload)
+
+    if (lifenumbers is None) == (layer_lists is None):
+        raise InvalidUsage('Exactly one of lifenumbers or layers must be passed.')
+
+    cell_count = len(lifenumbers if lifenumbers is not None else layer_lists)
+    if not cell_count:
+        raise InvalidUsage('No horses passed.')
+    if cell_count > SHEET_MAX_CELLS:
+        raise InvalidUsage(f'Too many horses. The maximum is {SHEET_MAX_CELLS}.', extra={'name': 'too_many_horses'})
+    if not SHEET_MIN_CELL_SIZE <= thumbnail_size <= SHEET_MAX_CELL_SIZE:
+        raise InvalidUsage(
+            f'Thumbnail size must be between {SHEET_MIN_CELL_SIZE} and {SHEET_MAX_CELL_SIZE}.',
+            extra={'name': 'thumbnail_size_invalid'},
+        )
+    if columns is None:
+        columns = math.ceil(math.sqrt(cell_count))
+    elif columns < 1:
+        raise InvalidUsage('Invalid number of columns.', extra={'name': 'columns_invalid'})
+    columns = min(columns, cell_count)
+
+    if image not in (None, 'adult', 'foal'):
+        raise InvalidUsage('Invalid image. Must be one of adult, foal.', extra={'name': 'image_invalid'})
+
+    hr: horsereality.Client = request.app.ctx.hr
+
+    cells: List[List[horsereality.Layer]]
+    if lifenumbers is not None:
+        if any(lifenumber < 1 for lifenumber in lifenumbers):
+            raise InvalidUsage('Invalid lifenumber.')
+
+        bulk_semaphore: asyncio.Semaphore = request.app.ctx.bulk_semaphore
+
+        async def get_horse(lifenumber: int) -> horsereality.Horse:
+            async with bulk_semaphore:
+                return await hr.get_horse(lifenumber)
+
+        cells = []
+        for horse in await asyncio.gather(*(get_horse(lifenumber) for lifenumber in lifenumbers)):
+            horse_layers = horse_layers_for(horse, use_whites=use_whites)
+            side = image or ('adult' if horse_layers['adult'] else 'foal')
+            if not horse_layers[side]:
+                raise NotFound(f'Horse {horse.lifenumber} has no {side} layers.', extra={'name': 'no_layers'})
+            cells.append(horse_layers[side])
+    else:
+        cells = []
+        for urls in layer_lists:
+            if not urls:
+                raise InvalidUsage('Invalid layer URLs passed.')
+            cells.append(create_layers(hr, urls))
+
+    layers = [layer for cell in cells for layer in cell]
+    counts = [len(cell) for cell in cells]
+    left_watermark = all(cell[0].horse_type == 'foals' for cell in cells)
+
+    async def render() -> bytes:
+        fetcher: LayerFetcher = request.app.ctx.layer_fetcher
         try:
-            img_data = await layer.read()
-        except horsereality.HTTPException as exc:
-            raise InvalidUsage(f'{exc.status} when fetching layer at position {layers.index(layer)}: {layer.url_path}')
-        else:
-            bytefiles.append(img_data)
+            bytefiles = await fetcher.read_many(layers)
+        except LayerFetchError as exc:
+            raise InvalidUsage(f'{exc.original.status} when fetching layer: {exc.layer.url_path}')
 
-    loop = asyncio.get_event_loop()
-    try:
-        merged = await loop.run_in_executor(None, partial(
-            pil_process,
-            bytefiles,
+        engine: CompositingEngine = request.app.ctx.engine
+        try:
+            return await engine.run(
+                sheet_process,
+                bytefiles,
+                counts=counts,
+                keys=[layer.url_path for layer in layers],
+                columns=columns,
+                cell_size=thumbnail_size,
+                use_watermark=use_watermark,
+                left_watermark=left_watermark,
+                encoding=encoding,
+            )
+        except:
+            raise ServerError('Failed to merge images.')
+
+    results: Optional[LRUCache] = request.app.ctx.merge_results
+    if results is None:
+        merged = await render()
+    else:
+        result_key = merge_key(
+            layers,
+            sheet=True,
+            counts=counts,
+            columns=columns,
+            cell_size=thumbnail_size,
             use_watermark=use_watermark,
-            left_watermark=layers[0].horse_type == 'foals',
+            left_watermark=left_watermark,
+            encoding=asdict(encoding),
+        )
+        merged = await results.get_or_fetch(result_key, render)
+
+    if format == 'binary':
+        return with_etag(request, r.raw(
+            merged,
+            content_type=encoding.mimetype,
+            headers=request.app.ctx.cors_headers(request),
         ))
-    except:
-        raise ServerError('Failed to merge images.')
 
-    return r.json(
+    return with_etag(request, r.json(
         {
-            'merged': merged,
+            'merged': data_uri(merged, encoding.mimetype),
+            'columns': columns,
         },
         status=200,
         headers=request.app.ctx.cors_headers(request),
-    )
+    ))
 
 
-@api.get(r'/multi-share/<share_id:(\d{10})>')
-async def get_share_data(request: sanic.Request, share_id: str):
-    if not request.app.ctx.redis:
+def get_share_store(request: sanic.Request) -> ShareStore:
+    store: Optional[ShareStore] = request.app.ctx.share_store
+    if store is None:
         raise InvalidUsage('This instance of Realtools does not support the share feature.')
+    return store
 
-    key = f'realtools-multishare-{share_id}'
-    share_data = await request.app.ctx.redis.get(key)
-    if share_data is None:
-        raise NotFound('No such share ID exists.')
 
+async def load_share(request: sanic.Request, share_id: str) -> dict:
+    store = get_share_store(request)
+    share_cache: Optional[ShareCache] = request.app.ctx.share_cache
     try:
-        data = json.loads(share_data)
-    except json.JSONDecodeError:
+        if share_cache is not None:
+            data = await share_cache.get(share_id)
+        else:
+            share_data = await store.get(share_key(share_id))
+            data = decode_share(share_id, share_data) if share_data is not None else None
+    except ValueError:
         raise ServerError('Failed to load share data.')
 
+    if data is None:
+        raise NotFound('No such share ID exists.')
+
     if not data.get('layers') or not data.get('layers'):
         raise InvalidUsage('The saved format for this share ID is invalid. It is likely just old.')
 
+    return data
+
+
+def share_layer_urls(data: dict) -> List[str]:
+    """The URLs of a share's enabled layers, from bottom to top.
+
+    ``layers`` maps each layer's ``key_id`` to the layer as the Multi tool
+    sees it, and ``enabled`` lists the ``key_id``s of the layers that are
+    switched on.
+    """
+
+    enabled = set(data['enabled'])
+    try:
+        shared_layers = sorted(
+            (layer for key_id, layer in data['layers'].items() if key_id in enabled),
+            key=lambda layer: layer.get('index', 0),
+        )
+        return [layer.get('url') or layer['large_url'] for layer in shared_layers]
+    except (AttributeError, KeyError, TypeError):
+        raise InvalidUsage('The saved format for this share ID is invalid. It is likely just old.')
+
+
+@api.get(f'/multi-share/<share_id:({SHARE_ID_PATTERN})>')
+async def get_share_data(request: sanic.Request, share_id: str):
+    data = await load_share(request, share_id)
     return r.json(data)
 
 
+@api.get(f'/multi-share/<share_id:({SHARE_ID_PATTERN})>/image')
+async def get_share_image(request: sanic.Request, share_id: str):
+    """Merge Shared Layers
+
+    Merge the enabled layers of a share. The image is rendered once and then
+    kept for as long as the share itself.
+
+    openapi:
+    ---
+    responses:
+        '200':
+            description: The merged image.
+    """
+    encoding: Encoding = output_encoding(request, {})
+    store = get_share_store(request)
+    data = await load_share(request, share_id)
+
+    key = share_key(share_id)
+    image_key = f'{key}-image-{encoding.format}'
+    stored = await store.get_with_ttl(image_key)
+    if stored is not None:
+        merged, expires_in = stored
+    else:
+        urls = share_layer_urls(data)
+        if not urls:
+            raise NotFound('This share has no enabled layers.', extra={'name': 'no_layers'})
+
+        layers = create_layers(request.app.ctx.hr, urls)
+        merged = await merge_layers(request.app, layers, use_watermark=True, encoding=encoding)
+
+        # The image can't outlive the share, and has to be set with the time
+        # left on the share rather than a fresh week
+        expires_in = await store.ttl(key)
+        if expires_in:
+            await store.set(image_key, merged, ttl=expires_in)
+
+    # Shares never change, so clients can keep the image until it expires
+    max_age = (expires_in or 0) // 1000
+    return with_etag(request, r.raw(
+        merged,
+        content_type=encoding.mimetype,
+        headers={
+            'Cache-Control': f'public, max-age={max_age}, immutable',
+            'Vary': 'Accept',
+            **request.app.ctx.cors_headers(request),
+        },
+    ))
+
+
 @api.post('/multi-share')
 async def create_share_link(request: sanic.Request):
-    if not request.app.ctx.redis:
-        raise InvalidUsage('This instance of Realtools does not support the share feature.')
+    store = get_share_store(request)
 
     payload = request.json
     try:
@@ -304,21 +1127,21 @@ async def create_share_link(request: sanic.Request):
     except (KeyError, AssertionError):
         raise InvalidUsage('Invalid data format provided.')
 
-    expires_after = 604800  # 1 week
-    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_after)
-    random_id = random.randint(1000000000, 9999999999)
-    key = f'realtools-multishare-{random_id}'
-    await request.app.ctx.redis.set(key, json.dumps(data))
-    await request.app.ctx.redis.expire(key, expires_after)
+    # Shares are named after their content, so sharing the same layers again
+    # gives the same ID and just restarts its expiry
+    canonical = canonicalize(data)
+    new_id = share_id(canonical)
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=SHARE_TTL)
+    await store.set(share_key(new_id), encode_share(canonical), ttl=SHARE_TTL * 1000)
     return r.json(
         {
-            'id': random_id,
+            'id': new_id,
             'url': urlunparse((
                 request.headers.get('X-Forwarded-Proto', 'http'),
                 request.headers['Host'],
                 '/merge/multi',
                 None,
-                f'share={random_id}',
+                f'share={new_id}',
                 None
             )),
             'expires': int(expires.timestamp())
@@ -333,4 +1156,6 @@ async def cors_preflight(request: sanic.Request):
 
 api.add_route(cors_preflight, '/merge', ['OPTIONS'])
 api.add_route(cors_preflight, '/merge/multiple', ['OPTIONS'])
+api.add_route(cors_preflight, '/merge/bulk', ['OPTIONS'])
+api.add_route(cors_preflight, '/merge/sheet', ['OPTIONS'])
 api.add_route(cors_preflight, '/multi-share', ['OPTIONS'])
@@ -0,0 +1,417 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+import hashlib
+import io
+from io import BytesIO
+import math
+import mmap
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from .cache import BufferPool, LRUCache
+from .layers import LayerData
+
+
+def image_size(image: Image.Image) -> int:
+    """The number of bytes that ``image``'s pixels take up in memory."""
+    return image.width * image.height * len(image.getbands())
+
+
+@dataclass(frozen=True)
+class DecodedLayer:
+    """An RGBA layer cropped to the part of it that isn't transparent.
+
+    ``size`` is the size of the whole layer and ``offset`` is where ``image``
+    sits in it. ``image`` is None if the whole layer is transparent.
+    """
+
+    image: Optional[Image.Image]
+    offset: Tuple[int, int]
+    size: Tuple[int, int]
+
+    def nbytes(self) -> int:
+        return image_size(self.image) if self.image is not None else 0
+
+
+# Decoded RGBA layers keyed by (URL path, target size), where the target size
+# is None for the first layer of a merge since that layer decides the size of
+# the canvas. This is per-process and set by `configure`
+decoded_layers: Optional[LRUCache] = None
+
+# Composites of the first few layers of a merge, keyed by `prefix_keys`, so
+# that a merge that only differs from an earlier one after some position can
+# start from the last checkpoint before it. Also per-process and set by `configure`
+prefix_composites: Optional[LRUCache] = None
+
+# The strip above a watermarked image, with the logo already in place, keyed
+# by (width, left). Only its width depends on the image
+watermark_strips = LRUCache(16 * 1024 * 1024, sizeof=image_size)
+
+# Scratch buffers that merges borrow and give back instead of allocating new
+# ones every time. Canvases are keyed by (width, height)
+image_canvases = BufferPool(lambda size: Image.new('RGBA', size), 64 * 1024 * 1024, sizeof=image_size)
+encode_buffers = BufferPool(lambda _: BytesIO(), 32 * 1024 * 1024, sizeof=lambda bio: len(bio.getbuffer()))
+
+LOGO_PATH = 'static/horse-reality-logo-small.png'
+
+
+def configure(*, decoded_cache_size: int = 0, prefix_cache_size: int = 0) -> None:
+    """Set up this process's image caches.
+
+    Sizes are in bytes; 0 disables a cache.
+    """
+
+    global decoded_layers, prefix_composites
+    decoded_layers = LRUCache(decoded_cache_size, sizeof=DecodedLayer.nbytes) if decoded_cache_size > 0 else None
+    prefix_composites = LRUCache(prefix_cache_size, sizeof=image_size) if prefix_cache_size > 0 else None
+
+    load_logo()
+
+
+class MemoryReader(io.RawIOBase):
+    """A read-only file over a memoryview that reads from it in place.
+
+    Unlike BytesIO, this never copies the whole view.
+    """
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self._view[self._position:self._position + len(buffer)]
+        length = len(chunk)
+        buffer[:length] = chunk
+        self._position += length
+        return length
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError('Negative seek position.')
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+
+def decode_layer(
+    data: LayerData,
+    size: Optional[Tuple[int, int]] = None,
+    *,
+    key: Optional[str] = None,
+) -> DecodedLayer:
+    """Decode a layer as RGBA, resizing it to ``size`` if it is given.
+
+    When ``key`` is given, the result is cached by ``(key, size)`` and may be
+    shared with other callers, so it must not be modified in place.
+    """
+
+    if key is not None and decoded_layers is not None:
+        cached = decoded_layers.get((key, size))
+        if cached is not None:
+            return cached
+
+    # Layers from the on-disk store are already file-like, and views of
+    # shared memory only need wrapping, so neither is copied into memory first
+    if isinstance(data, mmap.mmap):
+        fp = data
+    elif isinstance(data, memoryview):
+        fp = MemoryReader(data)
+    else:
+        fp = BytesIO(data)
+    opened = image = Image.open(fp, formats=('PNG',))
+
+    if size is not None and image.size != size:
+        # sometimes images will not be the same resolution, which causes
+        # Pillow to complain. luckily we can just resize to the previous
+        # image's size without really any issues
+        image = image.resize(size)
+
+    if image.mode != 'RGBA':
+        # sometimes images are opened in LA mode, which causes them
+        # to not be merge-able
+        image = image.convert('RGBA')
+
+    # Most layers only cover part of the horse. Compositing just that part
+    # keeps Pillow's temporary images that size rather than the whole canvas
+    bbox = image.getbbox()
+    if bbox is None:
+        layer = DecodedLayer(None, (0, 0), image.size)
+    elif bbox == (0, 0, *image.size):
+        if key is not None and decoded_layers is not None and image is opened:
+            # Don't keep the layer's file open for as long as it's cached
+            image = image.copy()
+        layer = DecodedLayer(image, (0, 0), image.size)
+    else:
+        layer = DecodedLayer(image.crop(bbox), bbox[:2], image.size)
+
+    if key is not None and decoded_layers is not None:
+        decoded_layers.set((key, size), layer)
+
+    return layer
+
+
+# Called with the position of each layer once it has been composited and the
+# canvas as it is at that point, which is only valid during the call
+LayerCallback = Callable[[int, Image.Image], None]
+
+
+@contextmanager
+def composite(
+    layers: List[DecodedLayer],
+    *,
+    base: Optional[Image.Image] = None,
+    on_layer: Optional[LayerCallback] = None,
+) -> Iterator[Image.Image]:
+    """Stack same-sized ``layers`` on top of each other, first to last.
+
+    If ``base`` is given, ``layers`` are stacked on top of it instead of on a
+    transparent canvas. The result is drawn on a pooled canvas that is given
+    back once the ``with`` block exits, so it must be copied if it is needed
+    afterwards.
+    """
+
+    size = base.size if base is not None else layers[0].size
+    # each horse's resolution is apparently just a little different, which
+    # is why canvases are pooled by size
+    with image_canvases.borrow(size) as canvas:
+        if base is None:
+            canvas.paste((0, 0, 0, 0), (0, 0, *canvas.size))
+        else:
+            canvas.paste(base, (0, 0))
+
+        for position, layer in enumerate(layers):
+            if layer.image is not None:
+                canvas.alpha_composite(layer.image, dest=layer.offset)
+            if on_layer is not None:
+                on_layer(position, canvas)
+        yield canvas
+
+
+def prefix_keys(keys: List[str]) -> List[str]:
+    """Return a key for each prefix of ``keys``, the first being for ``keys[:1]``."""
+
+    digest = hashlib.sha256()
+    prefixes = []
+    for key in keys:
+        digest.update(key.encode('utf-8'))
+        digest.update(b'\0')
+        prefixes.append(digest.copy().hexdigest())
+    return prefixes
+
+
+def cached_prefix(prefixes: List[str]) -> Tuple[int, Optional[Image.Image]]:
+    """Find the longest of ``prefixes`` that has a cached composite.
+
+    Returns how many layers that composite covers along with the composite
+    itself, or ``(0, None)`` if none of them do.
+    """
+
+    if prefix_composites is not None:
+        for length in range(len(prefixes), 0, -1):
+            # Checked first so that probing for shorter prefixes doesn't
+            # count as a miss
+            if prefixes[length - 1] in prefix_composites:
+                image = prefix_composites.get(prefixes[length - 1])
+                if image is not None:
+                    return length, image
+        prefix_composites.misses += 1
+    return 0, None
+
+
+def cache_prefixes(prefixes: List[str], start: int) -> Optional[LayerCallback]:
+    """Return an ``on_layer`` callback that caches checkpoints of the prefixes after ``start`` layers.
+
+    Every prefix is a full frame, so only every ``ceil(sqrt(n))``th one of
+    ``n`` prefixes is kept. A merge that starts from a checkpoint then
+    composites at most that many layers more than it would have otherwise.
+    Cached composites are copies, since the canvas they were drawn on goes
+    back to its pool afterwards.
+    """
+
+    if prefix_composites is None:
+        return None
+
+    interval = math.ceil(math.sqrt(len(prefixes)))
+
+    def on_layer(position: int, canvas: Image.Image) -> None:
+        length = start + position + 1
+        if length % interval == 0:
+            prefix_composites.set(prefixes[length - 1], canvas.copy())
+
+    return on_layer
+
+
+@lru_cache(maxsize=None)
+def load_logo() -> Image.Image:
+    """The watermark logo as it looks composited onto a transparent canvas.
+
+    This is decoded once per process.
+    """
+
+    logo = Image.open(LOGO_PATH).convert('RGBA')
+    return Image.alpha_composite(Image.new('RGBA', logo.size), logo)
+
+
+def add_horse_reality_logo(
+    image: Image.Image,
+    *,
+    left: bool = False,
+    canvas: Optional[Image.Image] = None,
+) -> Image.Image:
+    """Return ``image`` with the logo in a new strip above it.
+
+    If ``canvas`` is given, it is drawn on and returned instead of a new
+    image. It must be as wide as ``image`` and as tall as ``image`` plus the
+    logo, which :func:`watermarked_size` gives.
+    """
+
+    logo = load_logo()
+
+    strip = watermark_strips.get((image.width, left))
+    if strip is None:
+        strip = Image.new('RGBA', (image.width, logo.height))
+        # The strip is otherwise empty, so pasting the precomposited logo
+        # there gives the same pixels as compositing the original logo over it
+        if left:
+            strip.paste(logo, (0, 0))  # top left
+        else:
+            strip.paste(logo, (strip.width - logo.width, 0))  # top right
+        watermark_strips.set((image.width, left), strip)
+
+    if canvas is None:
+        new_image = Image.new('RGBA', (image.width, image.height + logo.height))
+    else:
+        new_image = canvas
+    # Between them, these two cover every pixel of the canvas
+    new_image.paste(strip, (0, 0))
+    new_image.paste(image, (0, logo.height))
+    return new_image
+
+
+def watermarked_size(size: Tuple[int, int]) -> Tuple[int, int]:
+    """The size of an image of ``size`` once the logo has been added to it."""
+    return (size[0], size[1] + load_logo().height)
+
+
+def contact_sheet(thumbnails: List[Image.Image], *, columns: int, cell_size: int) -> Image.Image:
+    """Lay ``thumbnails`` out left to right and top to bottom in square cells.
+
+    Each thumbnail is centered in its cell and must already fit in it.
+    """
+
+    rows = -(-len(thumbnails) // columns)
+    sheet = Image.new('RGBA', (columns * cell_size, rows * cell_size))
+    for position, thumbnail in enumerate(thumbnails):
+        row, column = divmod(position, columns)
+        sheet.paste(thumbnail, (
+            column * cell_size + (cell_size - thumbnail.width) // 2,
+            row * cell_size + (cell_size - thumbnail.height) // 2,
+        ))
+    return sheet
+
+
+def make_thumbnail(image: Image.Image, cell_size: int) -> Image.Image:
+    """Return a copy of ``image`` shrunk to fit a ``cell_size`` square, keeping its aspect ratio."""
+
+    scale = min(cell_size / image.width, cell_size / image.height, 1)
+    size = (max(round(image.width * scale), 1), max(round(image.height * scale), 1))
+    if size == image.size:
+        return image.copy()
+    return image.resize(size, Image.LANCZOS)
+
+
+# Encoder settings for each preset, from fastest to encode to smallest output
+PRESETS = ('fast', 'balanced', 'small')
+PNG_COMPRESS_LEVELS = {'fast': 1, 'balanced': 6, 'small': 9}
+WEBP_METHODS = {'fast': 0, 'balanced': 4, 'small': 6}
+WEBP_LOSSLESS_EFFORTS = {'fast': 0, 'balanced': 80, 'small': 100}
+AVIF_SPEEDS = {'fast': 8, 'balanced': 6, 'small': 4}
+
+
+def supported_formats() -> List[str]:
+    """The output formats that this install of Pillow is able to write."""
+
+    Image.init()
+    return [name for name in ('png', 'webp', 'avif') if name.upper() in Image.SAVE]
+
+
+@dataclass(frozen=True)
+class Encoding:
+    """How a merged image is encoded.
+
+    ``quality`` is ignored for PNG, and leaving it out for WebP produces a
+    lossless image. AVIF is always lossy.
+    """
+
+    format: str = 'png'
+    quality: Optional[int] = None
+    preset: str = 'balanced'
+
+    def __post_init__(self):
+        if self.format not in supported_formats():
+            raise ValueError(f'Unsupported image format {self.format!r}. Must be one of {", ".join(supported_formats())}.')
+        if self.preset not in PRESETS:
+            raise ValueError(f'Invalid preset {self.preset!r}. Must be one of {", ".join(PRESETS)}.')
+        if self.quality is not None and not 0 <= self.quality <= 100:
+            raise ValueError('Quality must be between 0 and 100.')
+
+    @property
+    def mimetype(self) -> str:
+        return f'image/{self.format}'
+
+    def save_options(self) -> Dict[str, Any]:
+        if self.format == 'png':
+            return {'compress_level': PNG_COMPRESS_LEVELS[self.preset]}
+
+        if self.format == 'webp':
+            if self.quality is None:
+                return {
+                    'lossless': True,
+                    'quality': WEBP_LOSSLESS_EFFORTS[self.preset],
+                    'method': WEBP_METHODS[self.preset],
+                }
+            return {'quality': self.quality, 'method': WEBP_METHODS[self.preset]}
+
+        return {
+            'quality': 75 if self.quality is None else self.quality,
+            'speed': AVIF_SPEEDS[self.preset],
+        }
+
+
+def encode_image(image: Image.Image, encoding: Encoding) -> bytes:
+    with encode_buffers.borrow(None) as bio:
+        # Truncating would free the buffer's memory, so it's overwritten from
+        # the start instead and only the part that was written is returned
+        bio.seek(0)
+        image.save(bio, format=encoding.format.upper(), **encoding.save_options())
+        length = bio.tell()
+        with bio.getbuffer() as view:
+            return bytes(view[:length])
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        'decoded_layers': decoded_layers.stats() if decoded_layers is not None else None,
+        'prefix_composites': prefix_composites.stats() if prefix_composites is not None else None,
+        'watermark_strips': watermark_strips.stats(),
+        'pools': {
+            'image_canvases': image_canvases.stats(),
+            'encode_buffers': encode_buffers.stats(),
+        },
+    }
@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from redis import asyncio as aioredis
+
+from .cache import LRUCache
+
+
+# How long a share lasts after it was last created, in seconds
+SHARE_TTL = 604800  # 1 week
+
+# Shares used to get random 10 digit IDs and are still readable by them.
+# Newer ones are named after a hash of their content
+LEGACY_ID_PATTERN = re.compile(r'\d{10}')
+ID_PATTERN = r'\d{10}|[A-Za-z0-9_-]{16}'
+
+# The first byte of every compressed share, so that the encoding can change
+# later without making existing shares unreadable
+FORMAT_VERSION = b'\x01'
+
+
+def canonicalize(data: Dict[str, Any]) -> bytes:
+    """Serialize a share so that the same layers always give the same bytes.
+
+    The order of ``enabled`` doesn't mean anything, so it is sorted.
+    """
+
+    data = {**data, 'enabled': sorted(data['enabled'], key=str)}
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def share_id(canonical: bytes) -> str:
+    """The ID of a share with ``canonical`` content, 16 URL-safe characters long."""
+    return base64.urlsafe_b64encode(hashlib.blake2b(canonical, digest_size=12).digest()).decode('ascii')
+
+
+def share_key(share_id: str) -> str:
+    if LEGACY_ID_PATTERN.fullmatch(share_id):
+        return f'realtools-multishare-{share_id}'
+    return f'realtools-share-{share_id}'
+
+
+def encode_share(canonical: bytes) -> bytes:
+    return FORMAT_VERSION + zlib.compress(canonical, 9)
+
+
+def decode_share(share_id: str, stored: bytes) -> Dict[str, Any]:
+    """Parse a share as it was stored under ``share_id``.
+
+    Raises ``ValueError`` if it can't be read.
+    """
+
+    if LEGACY_ID_PATTERN.fullmatch(share_id):
+        # Plain JSON
+        return json.loads(stored)
+
+    if stored[:1] != FORMAT_VERSION:
+        raise ValueError('Unknown share format.')
+    try:
+        return json.loads(zlib.decompress(stored[1:]))
+    except zlib.error as exc:
+        raise ValueError(str(exc)) from exc
+
+
+class ShareStore(ABC):
+    """Where shares and their rendered images are kept.
+
+    Keys are strings and values are bytes. Every value is set with a time to
+    live in milliseconds, after which it must no longer be returned.
+    """
+
+    name: str
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, *, ttl: int) -> None:
+        ...
+
+    @abstractmethod
+    async def ttl(self, key: str) -> Optional[int]:
+        """The milliseconds left before ``key`` expires, or None if it doesn't exist."""
+
+    async def get_with_ttl(self, key: str) -> Optional[Tuple[bytes, int]]:
+        """Both ``get`` and ``ttl`` at once, or None if ``key`` doesn't exist."""
+
+        value = await self.get(key)
+        ttl = await self.ttl(key)
+        if value is None or ttl is None:
+            return None
+        return value, ttl
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisShareStore(ShareStore):
+    name = 'redis'
+
+    def __init__(self, redis: aioredis.Redis):
+        self.redis = redis
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.redis.get(key)
+
+    async def set(self, key: str, value: bytes, *, ttl: int) -> None:
+        await self.redis.set(key, value, px=ttl)
+
+    async def ttl(self, key: str) -> Optional[int]:
+        # -2 if the key doesn't exist, and -1 if it never expires, which
+        # shares always do
+        remaining = await self.redis.pttl(key)
+        return remaining if remaining >= 0 else None
+
+    async def get_with_ttl(self, key: str) -> Optional[Tuple[bytes, int]]:
+        # One round trip rather than two
+        async with self.redis.pipeline(transaction=True) as pipe:
+            value, remaining = await pipe.get(key).pttl(key).execute()
+        if value is None or remaining < 0:
+            return None
+        return value, remaining
+
+
+class SQLiteShareStore(ShareStore):
+    """Keeps shares in an SQLite database, for instances without Redis.
+
+    Every query runs on one dedicated thread, so that the connection is never
+    shared between threads and the event loop never waits on the disk.
+    ``path`` may be ``:memory:`` for a database that only lasts as long as
+    the process.
+    """
+
+    name = 'sqlite'
+
+    # Expired rows are skipped when reading, and actually deleted once every
+    # this many writes
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='realtools-shares')
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self) -> None:
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        # Write-ahead logging without a sync on every commit keeps writes
+        # fast; at worst the last few shares are lost if the machine crashes
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS shares ('
+            'key TEXT PRIMARY KEY, '
+            'value BLOB NOT NULL, '
+            'expires INTEGER NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS shares_expires ON shares (expires)')
+        self._connection = connection
+
+    async def _run(self, func: Callable[..., Any], *args) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    def _get(self, key: str, now: int) -> Optional[bytes]:
+        row = self._connection.execute(
+            'SELECT value FROM shares WHERE key = ? AND expires > ?',
+            (key, now),
+        ).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def _set(self, key: str, value: bytes, expires: int) -> None:
+        self._connection.execute(
+            'INSERT INTO shares (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires',
+            (key, value, expires),
+        )
+
+        self.writes += 1
+        if self.writes % self.PURGE_INTERVAL == 0:
+            self._connection.execute('DELETE FROM shares WHERE expires <= ?', (_now(),))
+
+    def _get_with_ttl(self, key: str, now: int) -> Optional[Tuple[bytes, int]]:
+        row = self._connection.execute(
+            'SELECT value, expires FROM shares WHERE key = ? AND expires > ?',
+            (key, now),
+        ).fetchone()
+        return (bytes(row[0]), row[1] - now) if row is not None else None
+
+    def _ttl(self, key: str, now: int) -> Optional[int]:
+        row = self._connection.execute(
+            'SELECT expires FROM shares WHERE key = ? AND expires > ?',
+            (key, now),
+        ).fetchone()
+        return row[0] - now if row is not None else None
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._run(self._get, key, _now())
+
+    async def set(self, key: str, value: bytes, *, ttl: int) -> None:
+        await self._run(self._set, key, value, _now() + ttl)
+
+    async def ttl(self, key: str) -> Optional[int]:
+        return await self._run(self._ttl, key, _now())
+
+    async def get_with_ttl(self, key: str) -> Optional[Tuple[bytes, int]]:
+        return await self._run(self._get_with_ttl, key, _now())
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        self._executor.shutdown(wait=False)
+
+
+class ShareCache:
+    """Keeps recently read shares in memory, already parsed.
+
+    Each share is kept for at most ``ttl`` seconds, and never for longer than
+    it has left in ``store``, so an expired share is never served. Concurrent
+    reads of a share that isn't cached only read it from ``store`` once. The
+    cache is bounded by ``max_size`` bytes of stored share data.
+    """
+
+    def __init__(self, store: ShareStore, *, ttl: float, max_size: int):
+        self.store = store
+        self.ttl = ttl
+        self.expired = 0
+        # Values are (share, expires, stored size), where `expires` is on
+        # the loop's monotonic clock
+        self._entries = LRUCache(max_size, sizeof=lambda entry: entry[2])
+
+    async def _fetch(self, share_id: str) -> Tuple[Dict[str, Any], float, int]:
+        loop = asyncio.get_event_loop()
+        # The store's TTL is counted from some point after this, so counting
+        # it from here can only make the share expire early, never late
+        started = loop.time()
+        stored = await self.store.get_with_ttl(share_key(share_id))
+        if stored is None:
+            raise _ShareMissing
+
+        value, remaining = stored
+        return decode_share(share_id, value), started + min(self.ttl, remaining / 1000), len(value)
+
+    async def get(self, share_id: str) -> Optional[Dict[str, Any]]:
+        """The share with ``share_id``, or None if it doesn't exist.
+
+        Raises ``ValueError`` if the share can't be read.
+        """
+
+        loop = asyncio.get_event_loop()
+        if share_id in self._entries:
+            entry = self._entries.get(share_id)
+            if entry is not None:
+                if entry[1] > loop.time():
+                    return entry[0]
+                self._entries.pop(share_id)
+                self.expired += 1
+
+        try:
+            share, expires, _ = await self._entries.get_or_fetch(share_id, partial(self._fetch, share_id))
+        except _ShareMissing:
+            return None
+
+        if expires <= loop.time():
+            # Only possible for a share that was fetched for another caller
+            # and expired while this one was waiting for it
+            return None
+        return share
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._entries.stats(), 'expired': self.expired}
+
+
+class _ShareMissing(Exception):
+    pass
+
+
+def _now() -> int:
+    # Milliseconds, like Redis
+    return int(time.time() * 1000)
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import sanic
+from sanic import response as r
+
+from . import render
+
+
+api = sanic.Blueprint('Stats-v2')
+
+
+@api.get('/stats')
+async def get_stats(request: sanic.Request):
+    """Server Statistics
+
+    Return counters for this instance's caches.
+
+    openapi:
+    ---
+    responses:
+        '200':
+            description: Some statistics.
+    """
+
+    return r.json(
+        {
+            'layers': request.app.ctx.layer_fetcher.stats(),
+            'render': render.stats(),
+            'engine': request.app.ctx.engine.stats(),
+            'merge_results': request.app.ctx.merge_results.stats() if request.app.ctx.merge_results is not None else None,
+            'shares': request.app.ctx.share_cache.stats() if request.app.ctx.share_cache is not None else None,
+            'layer_index': request.app.ctx.layer_index.stats() if request.app.ctx.layer_index is not None else None,
+        },
+        headers=request.app.ctx.cors_headers(request),
+    )
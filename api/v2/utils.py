@@ -1,6 +1,9 @@
-from typing import Dict, List, Optional
+import asyncio
+from typing import Any, Dict, List, Mapping, Optional
 from horsereality import Layer, LayerType
 
+from .layer_index import LAYER_ID_COLUMNS, LayerTables
+
 
 # We use this static data with the "white patterns" and "untestable" dropdown
 # options in Realvision to supplement the specific genes being unavailable
@@ -304,6 +307,39 @@ white_pattern_reserves: Dict[str, Dict[str, Dict[str, Dict[str, str]]]] = {
 }
 
 
+def color_name_ids(colours: List[Layer]) -> List[str]:
+    """The layer IDs that ``name_color`` looks colour names up by."""
+
+    # Prefer a body layer for the color name if available
+    for layer in colours:
+        if layer.body_part == 'body':
+            return [layer.id]
+    return [layer.id for layer in colours]
+
+
+def color_name_rows(tables: LayerTables, breed: str, colours: List[Layer]) -> List[Mapping[str, Any]]:
+    """The ``color_layers`` rows that ``name_color`` would query for ``colours``."""
+
+    if not colours:
+        return []
+
+    return [
+        row for row in tables.color_layers.find(breed, color_name_ids(colours), columns=LAYER_ID_COLUMNS)
+        if row['dilution'] is not None
+        and row['color'] is not None
+        and row['base_genes'] is not None
+    ]
+
+
+def white_name_row(tables: LayerTables, breed: str, whites: List[Layer]) -> Optional[Mapping[str, Any]]:
+    """The ``testable_white_layers`` row that ``name_color`` would query for ``whites``."""
+
+    for row in tables.testable_white_layers.find(breed, [layer.id for layer in whites], columns=LAYER_ID_COLUMNS):
+        if row['white_gene'] is not None and row['color'] is not None:
+            return row
+    return None
+
+
 async def name_color(app, breed: str, layers: List[Layer]) -> Optional[Dict[str, str]]:
     # This is a very simple method that does not attempt to resolve duplicate
     # layer IDs and instead just returns the first result it finds.
@@ -322,86 +358,94 @@ async def name_color(app, breed: str, layers: List[Layer]) -> Optional[Dict[str,
     colours = [layer for layer in layers if layer.type is LayerType.colours]
     whites = [layer for layer in layers if layer.type is LayerType.whites]
 
+    if app.ctx.layer_index is not None and app.ctx.layer_index.current is not None:
+        tables = app.ctx.layer_index.current
+        return name_color_from_rows(layers, color_name_rows(tables, breed, colours), white_name_row(tables, breed, whites))
+
     pool = app.ctx.psql_pool
-    notes: List[str] = []
 
-    if colours:
-        # Prefer a body layer for the color name if available
-        body_layer: Optional[Layer] = None
-        try:
-            body_layer = [layer for layer in colours if layer.body_part == 'body'][0]
-        except IndexError:
-            pass
-
-        if body_layer:
-            query = (
-                '''
-                SELECT dilution, base_genes, color, body_part
-                FROM color_layers
-                WHERE breed = $1
-                AND (
-                    stallion_id = $2
-                    OR mare_id = $2
-                    OR foal_id = $2
-                )
-                AND dilution IS NOT NULL
-                AND color IS NOT NULL
-                AND base_genes IS NOT NULL
-                ''',
-                breed, body_layer.id
-            )
-        else:
-            query = (
-                '''
-                SELECT dilution, base_genes, color, body_part
-                FROM color_layers
+    async def fetch_colours() -> List[Mapping[str, Any]]:
+        if not colours:
+            return []
+
+        # color_layer_ids has a row for each ID of each layer, whether it is
+        # the stallion, mare or foal ID
+        return await pool.fetch(
+            '''
+            SELECT dilution, base_genes, color, body_part
+            FROM color_layers
+            WHERE id IN (
+                SELECT row_ref
+                FROM color_layer_ids
                 WHERE breed = $1
-                AND (
-                    stallion_id = ANY($2::text[])
-                    OR mare_id = ANY($2::text[])
-                    OR foal_id = ANY($2::text[])
-                )
-                AND dilution IS NOT NULL
-                AND color IS NOT NULL
-                AND base_genes IS NOT NULL
-                ''',
-                breed, [layer.id for layer in colours]
+                AND layer_id = ANY($2::text[])
             )
+            AND dilution IS NOT NULL
+            AND color IS NOT NULL
+            AND base_genes IS NOT NULL
+            ORDER BY block, ordinal, id
+            ''',
+            breed, color_name_ids(colours)
+        )
 
-        colours_data_rows = await pool.fetch(*query)
-        unique = set()
-        for row in colours_data_rows:
-            if row['body_part'] == 'body':
-                # We only care about adding the note if the body layer has duplicates
-                unique.add(row['color'])
-
-        if len(unique) > 1:
-            notes.append('duplicate_color_found')
-
-        colours_data = colours_data_rows[0]
-    else:
-        colours_data = {}
+    async def fetch_whites() -> Optional[Mapping[str, Any]]:
+        if not whites:
+            return None
 
-    if whites:
         # We don't need to get untestable layers here because we don't have
         # names for them and we already have their values
-        whites_data = await pool.fetchrow(
+        return await pool.fetchrow(
             '''
             SELECT white_gene, color, roan, rab
             FROM testable_white_layers
-            WHERE breed = $1
-            AND (
-                stallion_id = ANY($2::text[])
-                OR mare_id = ANY($2::text[])
-                OR foal_id = ANY($2::text[])
+            WHERE id IN (
+                SELECT row_ref
+                FROM testable_white_layer_ids
+                WHERE breed = $1
+                AND layer_id = ANY($2::text[])
             )
             AND white_gene IS NOT NULL
             AND color IS NOT NULL
+            ORDER BY block, ordinal, id
+            LIMIT 1
             ''',
             breed, [layer.id for layer in whites]
         )
-    else:
-        whites_data = {}
+
+    # These are independent, so they go out at the same time on separate
+    # connections from the pool
+    colours_data_rows, whites_data = await asyncio.gather(fetch_colours(), fetch_whites())
+    return name_color_from_rows(layers, colours_data_rows, whites_data)
+
+
+def name_color_from_rows(
+    layers: List[Layer],
+    colours_data_rows: List[Mapping[str, Any]],
+    whites_data: Optional[Mapping[str, Any]],
+) -> Optional[Dict[str, str]]:
+    """Name the color of ``layers`` from rows that were already fetched for them.
+
+    ``colours_data_rows`` are the ``color_layers`` rows matching
+    :func:`color_name_ids`, and ``whites_data`` is the first matching
+    ``testable_white_layers`` row, if any. See :func:`name_color`.
+    """
+
+    colours = [layer for layer in layers if layer.type is LayerType.colours]
+    whites = [layer for layer in layers if layer.type is LayerType.whites]
+    notes: List[str] = []
+
+    colours_data: Mapping[str, Any] = {}
+    if colours:
+        unique = set()
+        for row in colours_data_rows:
+            if row['body_part'] == 'body':
+                # We only care about adding the note if the body layer has duplicates
+                unique.add(row['color'])
+
+        if len(unique) > 1:
+            notes.append('duplicate_color_found')
+
+        colours_data = colours_data_rows[0]
 
     data: Dict[str, str] = {
         'dilution': '',
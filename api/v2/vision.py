@@ -11,7 +11,8 @@ from sanic import response as r
 from sanic.exceptions import InvalidUsage, NotFound
 from sanic_ext import validate
 
-from .utils import name_color, white_pattern_reserves
+from .layer_index import LayerTable, LayerTables
+from .utils import color_name_ids, color_name_rows, name_color_from_rows, white_name_row, white_pattern_reserves
 import horsereality
 import predictor
 
@@ -22,6 +23,156 @@ if TYPE_CHECKING:
 api = sanic.Blueprint('Vision-v2')
 log = logging.getLogger('realtools')
 
+# The rows that predict_with_layers needs, tagged by where they came from:
+# - colour: color_layers rows for the foal's colour layers ($2)
+# - untestable_white, testable_white: white rows for the foal's white layers ($3)
+# - roan_rab: the breed's roan and rabicano white layers
+# - color_name, white_name: what name_color would look up for the foal ($4 is
+#   from color_name_ids), for name_color_from_rows
+PREDICTION_SOURCES = ('colour', 'untestable_white', 'testable_white', 'roan_rab', 'color_name', 'white_name')
+PREDICTION_QUERY = '''
+WITH prediction_rows AS (
+    SELECT
+        'colour' AS source, body_part, stallion_id, mare_id, foal_id,
+        dilution, base_genes, color, NULL::text AS white_gene, NULL::boolean AS roan, NULL::boolean AS rab,
+        block, ordinal, id
+    FROM color_layers
+    WHERE breed = $1
+    AND foal_id = ANY($2::text[])
+
+    UNION ALL
+    SELECT
+        'untestable_white', body_part, stallion_id, mare_id, foal_id,
+        NULL, NULL, NULL, NULL, roan, rab,
+        NULL, NULL, NULL
+    FROM white_layers
+    WHERE breed = $1
+    AND foal_id = ANY($3::text[])
+
+    UNION ALL
+    SELECT
+        'testable_white', body_part, stallion_id, mare_id, foal_id,
+        NULL, NULL, color, white_gene, roan, rab,
+        block, ordinal, id
+    FROM testable_white_layers
+    WHERE breed = $1
+    AND foal_id = ANY($3::text[])
+
+    UNION ALL
+    SELECT
+        'roan_rab', body_part, stallion_id, mare_id, foal_id,
+        NULL, NULL, color, white_gene, roan, rab,
+        block, ordinal, id
+    FROM testable_white_layers
+    WHERE breed = $1
+    AND color IN ('Roan', 'Rabicano')
+
+    UNION ALL
+    SELECT
+        'color_name', body_part, stallion_id, mare_id, foal_id,
+        dilution, base_genes, color, NULL, NULL, NULL,
+        block, ordinal, id
+    FROM color_layers
+    WHERE id IN (
+        SELECT row_ref
+        FROM color_layer_ids
+        WHERE breed = $1
+        AND layer_id = ANY($4::text[])
+    )
+    AND dilution IS NOT NULL
+    AND color IS NOT NULL
+    AND base_genes IS NOT NULL
+
+    UNION ALL
+    (
+        -- Only the first row in sheet order is wanted here, so this one is
+        -- ordered on its own as well
+        SELECT
+            'white_name', body_part, stallion_id, mare_id, foal_id,
+            NULL, NULL, color, white_gene, roan, rab,
+            block, ordinal, id
+        FROM testable_white_layers
+        WHERE id IN (
+            SELECT row_ref
+            FROM testable_white_layer_ids
+            WHERE breed = $1
+            AND layer_id = ANY($3::text[])
+        )
+        AND white_gene IS NOT NULL
+        AND color IS NOT NULL
+        ORDER BY block, ordinal, id
+        LIMIT 1
+    )
+)
+-- A UNION doesn't keep the order of its parts, so rows are put in sheet
+-- order once they're combined
+SELECT * FROM prediction_rows
+ORDER BY source, block, ordinal, id
+'''
+
+# The layers in the same sheet block as a body layer of a color, for
+# block_siblings. `sex` is formatted in as either stallion or mare
+COLOR_SIBLINGS_QUERY = '''
+SELECT sibling.body_part, sibling.stallion_id, sibling.mare_id
+FROM (
+    SELECT block
+    FROM color_layers
+    WHERE breed = $1
+    AND {sex}_id = $2
+    AND body_part = 'body'
+    AND color = $3
+    AND block IS NOT NULL
+    ORDER BY block, ordinal
+    LIMIT 1
+) AS anchor
+JOIN color_layers AS sibling
+ON sibling.breed = $1
+AND sibling.block = anchor.block
+ORDER BY sibling.ordinal
+'''
+WHITE_SIBLINGS_QUERY = '''
+SELECT sibling.body_part, sibling.stallion_id, sibling.mare_id
+FROM (
+    SELECT block, roan, rab
+    FROM testable_white_layers
+    WHERE breed = $1
+    AND {sex}_id = $2
+    AND body_part = 'body'
+    AND color = $3
+    AND block IS NOT NULL
+    ORDER BY block, ordinal
+    LIMIT 1
+) AS anchor
+JOIN testable_white_layers AS sibling
+ON sibling.breed = $1
+AND sibling.block = anchor.block
+AND sibling.roan IS NOT DISTINCT FROM anchor.roan
+AND sibling.rab IS NOT DISTINCT FROM anchor.rab
+ORDER BY sibling.ordinal
+'''
+
+
+def prediction_rows_from_index(
+    tables: LayerTables,
+    breed: str,
+    foal_colour_ids: List[str],
+    foal_white_ids: List[str],
+    layers: List[horsereality.Layer],
+) -> Dict[str, List[Any]]:
+    """The same rows as ``PREDICTION_QUERY``, by source, from the layer index."""
+
+    colours = [layer for layer in layers if layer.type is horsereality.LayerType.colours]
+    whites = [layer for layer in layers if layer.type is horsereality.LayerType.whites]
+    white_name = white_name_row(tables, breed, whites)
+    return {
+        'colour': tables.color_layers.find(breed, foal_colour_ids),
+        'untestable_white': tables.white_layers.find(breed, foal_white_ids),
+        'testable_white': tables.testable_white_layers.find(breed, foal_white_ids),
+        'roan_rab': tables.testable_white_layers.find(breed, ['Roan', 'Rabicano'], columns=('color',)),
+        'color_name': color_name_rows(tables, breed, colours),
+        'white_name': [white_name] if white_name is not None else [],
+    }
+
 
 @dataclass
 class PartialHorseInfo:
@@ -202,13 +353,9 @@ async def predict_with_layers(request: sanic.Request, horse: horsereality.Horse,
         sex = 'stallion'
 
     # Map out the foal's layer IDs
-    foal_colour_ids = []
-    foal_white_ids = []
-    for layer in horse.layers:
-        if layer.type is horsereality.LayerType.colours:
-            foal_colour_ids.append(layer.id)
-        elif layer.type is horsereality.LayerType.whites:
-            foal_white_ids.append(layer.id)
+    colours = [layer for layer in horse.layers if layer.type is horsereality.LayerType.colours]
+    foal_colour_ids = [layer.id for layer in colours]
+    foal_white_ids = [layer.id for layer in horse.layers if layer.type is horsereality.LayerType.whites]
 
     # Get layer orders
     orders = getattr(horsereality.BreedOrders, breed, None)
@@ -217,59 +364,45 @@ async def predict_with_layers(request: sanic.Request, horse: horsereality.Horse,
         raise NotFound('No data is available for this breed or sex, sorry. This will usually only happen on newer breeds that Realvision does not support yet.', extra={'name': 'no_data_orders'})
     orders = orders.value[sex]
 
+    # The same copy of the tables is used for the whole prediction
+    tables: Optional[LayerTables] = None
+    if request.app.ctx.layer_index is not None:
+        tables = request.app.ctx.layer_index.current
+
+    if tables is not None:
+        rows_by_source = prediction_rows_from_index(tables, breed, foal_colour_ids, foal_white_ids, horse.layers)
+    else:
+        # Everything needed to match the foal's layers and name its color
+        # comes back from one query, and is split up by source here
+        rows = await pool.fetch(PREDICTION_QUERY, breed, foal_colour_ids, foal_white_ids, color_name_ids(colours))
+        rows_by_source = {source: [] for source in PREDICTION_SOURCES}
+        for row in rows:
+            rows_by_source[row['source']].append(row)
+
     # Match to adult layers
-    colour_layer_rows = await pool.fetch(
-        '''
-        SELECT dilution, body_part, stallion_id, mare_id, foal_id, base_genes, color
-        FROM color_layers
-        WHERE breed = $1
-        AND foal_id = ANY($2::text[])
-        ''',
-        breed, foal_colour_ids
-    )
+    colour_layer_rows = rows_by_source['colour']
+    untestable_white_layer_rows = rows_by_source['untestable_white']
+    testable_white_layer_rows = rows_by_source['testable_white']
+    roan_rab_rows = rows_by_source['roan_rab']
+
     if not colour_layer_rows:
         log.debug(f'Found no colour layers while predicting {horse.lifenumber} - IDs {json.dumps(foal_colour_ids)}')
         raise NotFound('No data is available for this horse, sorry.', extra={'name': 'no_data_horse'})
 
-    # Duplicate tracking
-    colour_layer_id_counts = [row['foal_id'] for row in colour_layer_rows]
-
-    untestable_white_layer_rows = await pool.fetch(
-        '''
-        SELECT body_part, stallion_id, mare_id, rab, roan
-        FROM white_layers
-        WHERE breed = $1
-        AND foal_id = ANY($2::text[])
-        ''',
-        breed, foal_white_ids
+    color_info = name_color_from_rows(
+        horse.layers,
+        rows_by_source['color_name'],
+        next(iter(rows_by_source['white_name']), None),
     )
 
-    testable_white_layer_rows = await pool.fetch(
-        '''
-        SELECT body_part, stallion_id, mare_id, rab, roan
-        FROM testable_white_layers
-        WHERE breed = $1
-        AND foal_id = ANY($2::text[])
-        ''',
-        breed, foal_white_ids
-    )
+    # Duplicate tracking
+    colour_layer_id_counts = [row['foal_id'] for row in colour_layer_rows]
 
     white_layer_rows = untestable_white_layer_rows + testable_white_layer_rows
 
-    roan_rab_rows = await pool.fetch(
-        '''
-        SELECT body_part, stallion_id, mare_id, color
-        FROM testable_white_layers
-        WHERE breed = $1
-        AND color IN ('Roan', 'Rabicano')
-        ''',
-        breed
-    )
     roans = {row['body_part']: row for row in roan_rab_rows if row['color'] == 'Roan'}
     rabs = {row['body_part']: row for row in roan_rab_rows if row['color'] == 'Rabicano'}
 
-    color_info = await name_color(request.app, breed, horse.layers)
-
     white_urls = {}
     is_roan = False
     is_rab = False
@@ -482,95 +615,38 @@ async def predict_with_layers(request: sanic.Request, horse: horsereality.Horse,
 
         white_pattern_color_name += ' ' + ' '.join(white_pattern_color_name_to_add)
 
-    # Checking for gaps in data and attempting to fill them in with similar layers
-    before_table = {
-        # This has a static order because we are mimicking how layers are stored in the database
-        'body': 'tail',
-        'mane': 'body',
-        'tail': 'mane',
-    }
+    # Checking for gaps in data and attempting to fill them in with layers
+    # from the same sheet block as the body
 
     # colours
-    for missing in ['mane', 'tail']:
-        # It _could be_ missing
-        if missing not in urls_data:
-            # It's missing
-            possible_layer_rows = await pool.fetch(
-                '''
-                SELECT dilution, body_part, stallion_id, mare_id, base_genes, color
-                FROM color_layers
-                WHERE breed = $1
-                AND color = $2
-                ''',
-                breed, color_info['color']
-            )
-            before = before_table[missing]
-            try:
-                before_id = urls_data[before]['colours_id']
-            except KeyError:
-                # That one is missing too, abort
-                break
-
-            # I think this is not actually useful to have
-            missing_is_after = list(before_table.keys()).index(missing) > list(before_table.keys()).index(before)
-
-            for index, row in enumerate(possible_layer_rows):
-                if row[f'{sex}_id'] == before_id and row['body_part'] == before:
-                    missing_row = possible_layer_rows[index + (1 if missing_is_after else -1)]
-                    adult_id = missing_row[f'{sex}_id']
+    if any(missing not in urls_data for missing in ('mane', 'tail')):
+        siblings = await block_siblings(
+            pool, tables, 'color_layers', breed, sex, urls_data['body']['colours_id'], color_info['color']
+        )
+        for missing in ('mane', 'tail'):
+            if missing not in urls_data and missing in siblings:
+                adult_id = siblings[missing][f'{sex}_id']
+                if adult_id:
                     url = f'https://www.horsereality.com/upload/colours/{sex}s/{missing}/large/{adult_id}.png'
                     urls_data[missing] = {
                         'colours': url,
                     }
-                    break
 
     # whites
     if any(missing not in white_urls for missing in ('mane', 'tail')):
         # One of them is missing
-        possible_layer_rows = await pool.fetch(
-            '''
-            SELECT body_part, stallion_id, mare_id, color
-            FROM testable_white_layers
-            WHERE breed = $1
-            AND color = $2
-            ''',
-            breed, color_info['_raw_testable_color']
-        )
-        try:
-            possible_before_urls = white_urls['body']
-        except KeyError:
-            # Body is missing, abort
-            pass
-        else:
-            for possible_before_url in possible_before_urls:
-                before_id = horsereality.Layer(http=None, url=possible_before_url).id  # This is sort of overkill but it's convenient
-
-                for index, row in enumerate(possible_layer_rows):
-                    if row[f'{sex}_id'] == before_id and row['body_part'] == 'body':
-                        try:
-                            if 'mane' not in white_urls:
-                                missing_is_after = list(before_table.keys()).index('mane') > list(before_table.keys()).index('body')
-                                missing_row = possible_layer_rows[index + (1 if missing_is_after else -1)]
-                                adult_id = missing_row[f'{sex}_id']
-                                if adult_id:
-                                    url = f'https://www.horsereality.com/upload/whites/{sex}s/mane/large/{adult_id}.png'
-                                    urls_data['mane'] = urls_data.get('mane', {'colours': None})
-                                    urls_data['mane']['whites'] = [url]
-
-                            if 'tail' not in white_urls:
-                                missing_is_after = list(before_table.keys()).index('tail') > list(before_table.keys()).index('body')
-                                missing_row = possible_layer_rows[index + (2 if missing_is_after else -2)]
-                                adult_id = missing_row[f'{sex}_id']
-                                if adult_id:
-                                    url = f'https://www.horsereality.com/upload/whites/{sex}s/tail/large/{adult_id}.png'
-                                    urls_data['tail'] = urls_data.get('tail', {'colours': None})
-                                    urls_data['tail']['whites'] = [url]
-
-                        except IndexError:
-                            # We don't have the missing row even though we thought we did
-                            pass
-
-                        break
+        for possible_before_url in white_urls.get('body', []):
+            before_id = horsereality.Layer(http=None, url=possible_before_url).id  # This is sort of overkill but it's convenient
+            siblings = await block_siblings(
+                pool, tables, 'testable_white_layers', breed, sex, before_id, color_info['_raw_testable_color']
+            )
+            for missing in ('mane', 'tail'):
+                if missing not in white_urls and missing in siblings:
+                    adult_id = siblings[missing][f'{sex}_id']
+                    if adult_id:
+                        url = f'https://www.horsereality.com/upload/whites/{sex}s/{missing}/large/{adult_id}.png'
+                        urls_data[missing] = urls_data.get(missing, {'colours': None})
+                        urls_data[missing]['whites'] = [url]
 
     # We don't need this anymore
     color_info.pop('_raw_testable_color', None)
@@ -637,6 +713,51 @@ async def predict_with_layers(request: sanic.Request, horse: horsereality.Horse,
     )
 
 
+async def block_siblings(
+    pool: asyncpg.Pool,
+    tables: Optional[LayerTables],
+    table: str,
+    breed: str,
+    sex: str,
+    body_id: str,
+    color: Optional[str],
+) -> Dict[str, Any]:
+    """The rows in the same sheet block as the ``color`` body layer with
+    ``body_id``, by body part.
+
+    In ``testable_white_layers`` only rows with the same roan and rabicano
+    flags as the body layer count. The first block in sheet order is used if
+    the body layer is in more than one.
+    """
+
+    same_flags = table == 'testable_white_layers'
+    if tables is not None:
+        if color is None:
+            # Like in SQL
+            return {}
+
+        layer_table: LayerTable = getattr(tables, table)
+        anchors = [
+            row for row in layer_table.find(breed, [body_id], columns=(f'{sex}_id',))
+            if row['body_part'] == 'body' and row['color'] == color and row['block'] is not None
+        ]
+        if not anchors:
+            return {}
+
+        anchor = min(anchors, key=lambda row: (row['block'], row['ordinal']))
+        rows = layer_table.block(breed, anchor['block'])
+        if same_flags:
+            rows = [row for row in rows if row['roan'] == anchor['roan'] and row['rab'] == anchor['rab']]
+    else:
+        query = WHITE_SIBLINGS_QUERY if same_flags else COLOR_SIBLINGS_QUERY
+        rows = await pool.fetch(query.format(sex=sex), breed, body_id, color)
+
+    siblings = {}
+    for row in rows:
+        siblings.setdefault(row['body_part'], row)
+    return siblings
+
+
 async def cors_preflight(request: sanic.Request):
     return r.empty(headers=request.app.ctx.cors_headers(request))
 
@@ -1 +1,3 @@
 from .parse import SheetParser
+from .ingest import import_layers
+from .schema import migrate
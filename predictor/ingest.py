@@ -0,0 +1,45 @@
+from typing import Any, Dict, List
+
+import asyncpg
+
+# The columns written for each of SheetParser.parse's lists of layers
+LAYER_COLUMNS = {
+    'color_layers': (
+        'colors',
+        ('dilution', 'body_part', 'stallion_id', 'mare_id', 'foal_id', 'base_genes', 'color', 'block', 'ordinal'),
+    ),
+    'white_layers': (
+        'whites',
+        ('body_part', 'stallion_id', 'mare_id', 'foal_id', 'roan', 'rab'),
+    ),
+    'testable_white_layers': (
+        'testable_whites',
+        ('white_gene', 'body_part', 'stallion_id', 'mare_id', 'foal_id', 'roan', 'rab', 'color', 'block', 'ordinal'),
+    ),
+}
+
+
+async def import_layers(
+    connection: asyncpg.Connection,
+    breed: str,
+    layers: Dict[str, List[Dict[str, Any]]],
+    *,
+    channel: str = 'realtools_layers',
+):
+    """Replace the stored layers of ``breed`` with ``layers`` from :meth:`SheetParser.parse`.
+
+    This happens in one transaction, after which every running instance is
+    told to reload its layer index through ``channel``.
+    """
+
+    async with connection.transaction():
+        for table, (key, columns) in LAYER_COLUMNS.items():
+            await connection.execute(f'DELETE FROM {table} WHERE breed = $1', breed)
+            await connection.copy_records_to_table(
+                table,
+                records=[(breed, *(layer.get(column) for column in columns)) for layer in layers[key]],
+                columns=('breed', *columns),
+            )
+
+        # Only delivered once the transaction commits
+        await connection.execute('SELECT pg_notify($1, $2)', channel, breed)
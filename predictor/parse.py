@@ -2,7 +2,11 @@ import csv
 import json
 from io import StringIO
 
-config = json.load(open('config.json'))
+try:
+    config = json.load(open('config.json'))
+except FileNotFoundError:
+    # Only the sheets directory is read from it, which has a default
+    config = {}
 sheets_dir = config.get('sheets', 'sheets')
 
 IGNORE_VALUES = ('X', 'x', '')
@@ -126,6 +130,16 @@ class SheetParser:
         self.next_row_block_index = 2
         self.current_layer_block = []
         self.current_layer = {}
+        # Every colour layer has a `block` shared with the other body parts of
+        # the same color and base genes, and every testable white layer has
+        # one shared with the rest of its pattern. `ordinal` is its row in
+        # the block
+        self.next_block = 0
+
+    def new_block(self):
+        block = self.next_block
+        self.next_block += 1
+        return block
 
     def parse(self, breed=None, *, raw=None):
         all_rows = []
@@ -223,8 +237,9 @@ class SheetParser:
                             obj['color'] = color
 
                     self.next_row_block_index += 3
-                    for item in self.current_layer_block:
-                        testable_white_layers.append(item.copy())
+                    block = self.new_block()
+                    for ordinal, item in enumerate(self.current_layer_block):
+                        testable_white_layers.append({**item, 'block': block, 'ordinal': ordinal})
 
                     self.current_layer_block.clear()
 
@@ -314,6 +329,8 @@ class SheetParser:
                 self.current_layer_block.clear()
                 indexes = (2, 3, 4)
 
+            block = self.new_block()
+            ordinal = 0
             for row in all_rows[self.next_row_block_index:]:
                 if row[1].lower() == 'color':
                     if (color := row[indexes[0]]) == '-':
@@ -368,7 +385,8 @@ class SheetParser:
                     self.current_layer['foal_id'] = row[indexes[2]]
 
                     self.current_layer['base_genes'] = all_rows[0][indexes[0]]
-                    self.current_layer_block.append(self.current_layer.copy())
+                    self.current_layer_block.append({**self.current_layer, 'block': block, 'ordinal': ordinal})
+                    ordinal += 1
 
             walk_column((
                 indexes[0] + 3,
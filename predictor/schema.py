@@ -0,0 +1,208 @@
+import logging
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+import asyncpg
+
+log = logging.getLogger('realtools')
+
+# Any fixed number works, as long as every instance uses the same one so that
+# only one of them migrates at a time
+MIGRATION_LOCK = 0x7265616c
+
+
+async def create_layer_tables(connection: asyncpg.Connection):
+    # These are only created if they don't exist yet, so older databases keep
+    # whatever types they were made with
+    await connection.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS color_layers (
+            breed text NOT NULL,
+            dilution text,
+            body_part text,
+            stallion_id text,
+            mare_id text,
+            foal_id text,
+            base_genes text,
+            color text
+        );
+        CREATE TABLE IF NOT EXISTS white_layers (
+            breed text NOT NULL,
+            body_part text,
+            stallion_id text,
+            mare_id text,
+            foal_id text,
+            roan boolean,
+            rab boolean
+        );
+        CREATE TABLE IF NOT EXISTS testable_white_layers (
+            breed text NOT NULL,
+            white_gene text,
+            body_part text,
+            stallion_id text,
+            mare_id text,
+            foal_id text,
+            roan boolean,
+            rab boolean,
+            color text
+        );
+        '''
+    )
+
+
+def number_blocks(rows: List[asyncpg.Record], block_of: Callable[[asyncpg.Record], Tuple], part_of: Callable[[asyncpg.Record], Tuple]) -> List[Tuple[int, int, Tuple]]:
+    """Work out the sheet blocks of rows that were stored before blocks were.
+
+    ``rows`` must be in the order they were inserted. A new block starts
+    whenever ``block_of`` changes or a row repeats a ``part_of`` that is
+    already in the current block. Returns ``(block, ordinal, ctid)`` for
+    every row.
+    """
+
+    numbered = []
+    blocks: Dict[str, int] = {}
+    current = None
+    parts: Set[Tuple] = set()
+    for row in rows:
+        key = (row['breed'], block_of(row))
+        part = part_of(row)
+        if key != current or part in parts:
+            blocks[row['breed']] = blocks.get(row['breed'], -1) + 1
+            current = key
+            parts = set()
+            ordinal = 0
+
+        numbered.append((blocks[row['breed']], ordinal, row['ctid']))
+        parts.add(part)
+        ordinal += 1
+
+    return numbered
+
+
+async def add_layer_blocks(connection: asyncpg.Connection):
+    await connection.execute(
+        '''
+        ALTER TABLE color_layers
+            ADD COLUMN IF NOT EXISTS block integer,
+            ADD COLUMN IF NOT EXISTS ordinal integer;
+        ALTER TABLE testable_white_layers
+            ADD COLUMN IF NOT EXISTS block integer,
+            ADD COLUMN IF NOT EXISTS ordinal integer;
+        CREATE INDEX IF NOT EXISTS color_layers_block ON color_layers (breed, block);
+        CREATE INDEX IF NOT EXISTS testable_white_layers_block ON testable_white_layers (breed, block);
+        '''
+    )
+
+    # Rows that are already stored were inserted block by block, so their
+    # physical order is the only record of their blocks. This is the last
+    # time it is relied on
+    rows = await connection.fetch('SELECT ctid, breed, body_part, base_genes, color FROM color_layers ORDER BY ctid')
+    numbered = number_blocks(
+        rows,
+        lambda row: (row['base_genes'], row['color']),
+        lambda row: (row['body_part'],),
+    )
+    await connection.executemany('UPDATE color_layers SET block = $1, ordinal = $2 WHERE ctid = $3', numbered)
+
+    rows = await connection.fetch('SELECT ctid, breed, body_part, roan, rab, color FROM testable_white_layers ORDER BY ctid')
+    numbered = number_blocks(
+        rows,
+        lambda row: (row['color'],),
+        lambda row: (row['body_part'], row['roan'], row['rab']),
+    )
+    await connection.executemany('UPDATE testable_white_layers SET block = $1, ordinal = $2 WHERE ctid = $3', numbered)
+
+
+async def add_layer_id_lookups(connection: asyncpg.Connection):
+    # One row per layer ID of every color_layers and testable_white_layers
+    # row, so that a layer can be looked up by ID with a single index scan
+    # no matter which column the ID is in. `row_ref` is the row's `id`
+    for table, lookup in (('color_layers', 'color_layer_ids'), ('testable_white_layers', 'testable_white_layer_ids')):
+        await connection.execute(
+            f'''
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY;
+
+            CREATE TABLE IF NOT EXISTS {lookup} (
+                breed text NOT NULL,
+                layer_id text NOT NULL,
+                role text NOT NULL,
+                row_ref bigint NOT NULL REFERENCES {table} (id) ON DELETE CASCADE,
+                PRIMARY KEY (breed, layer_id, role, row_ref)
+            );
+            CREATE INDEX IF NOT EXISTS {lookup}_row_ref ON {lookup} (row_ref);
+
+            INSERT INTO {lookup} (breed, layer_id, role, row_ref)
+            SELECT breed, layer_id, role, id
+            FROM {table}
+            CROSS JOIN LATERAL (
+                VALUES (stallion_id, 'stallion'), (mare_id, 'mare'), (foal_id, 'foal')
+            ) AS ids (layer_id, role)
+            WHERE layer_id IS NOT NULL
+            ON CONFLICT DO NOTHING;
+
+            -- Keeps the lookup up to date however rows are written, which
+            -- includes import_layers
+            CREATE OR REPLACE FUNCTION {lookup}_sync() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE' THEN
+                    DELETE FROM {lookup} WHERE row_ref = OLD.id;
+                END IF;
+                INSERT INTO {lookup} (breed, layer_id, role, row_ref)
+                SELECT NEW.breed, layer_id, role, NEW.id
+                FROM (
+                    VALUES (NEW.stallion_id, 'stallion'), (NEW.mare_id, 'mare'), (NEW.foal_id, 'foal')
+                ) AS ids (layer_id, role)
+                WHERE layer_id IS NOT NULL;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS {lookup}_sync ON {table};
+            CREATE TRIGGER {lookup}_sync
+            AFTER INSERT OR UPDATE OF id, breed, stallion_id, mare_id, foal_id ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {lookup}_sync();
+            '''
+        )
+
+
+# Never change or remove a migration once it has been released; add another
+MIGRATIONS: List[Tuple[int, str, Callable[[asyncpg.Connection], Awaitable[None]]]] = [
+    (1, 'Create the layer tables', create_layer_tables),
+    (2, 'Number layers by sheet block', add_layer_blocks),
+    (3, 'Look layers up by ID', add_layer_id_lookups),
+]
+
+
+async def migrate(connection: asyncpg.Connection) -> List[int]:
+    """Apply any migrations that haven't been applied yet, returning their versions.
+
+    Everything happens in one transaction, so a failed migration leaves the
+    database as it was.
+    """
+
+    applied = []
+    async with connection.transaction():
+        await connection.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK)
+        await connection.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS realtools_schema (
+                version integer PRIMARY KEY,
+                description text NOT NULL,
+                applied_at timestamptz NOT NULL DEFAULT now()
+            )
+            '''
+        )
+        done = {row['version'] for row in await connection.fetch('SELECT version FROM realtools_schema')}
+
+        for version, description, apply in MIGRATIONS:
+            if version in done:
+                continue
+
+            log.info(f'Applying schema migration {version}: {description}')
+            await apply(connection)
+            await connection.execute(
+                'INSERT INTO realtools_schema (version, description) VALUES ($1, $2)',
+                version, description
+            )
+            applied.append(version)
+
+    return applied
@@ -0,0 +1,5 @@
+import os
+
+# The watermark logo and config.json are looked up relative to the working
+# directory, which is the repository root when the app runs
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from api.v2.shares import SHARE_TTL, ShareCache, ShareStore, SQLiteShareStore, canonicalize, encode_share, share_id, share_key
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteShareStore(str(tmp_path / 'shares.sqlite3'))
+    yield store
+    run(store.close())
+
+
+def test_share_store_is_abstract():
+    with pytest.raises(TypeError):
+        ShareStore()
+
+
+def test_sqlite_store_round_trip(store):
+    ttl = SHARE_TTL * 1000
+
+    async def main():
+        await store.set('key', b'value', ttl=ttl)
+        assert await store.get('key') == b'value'
+
+        remaining = await store.ttl('key')
+        assert 0 < remaining <= ttl
+
+        value, remaining = await store.get_with_ttl('key')
+        assert value == b'value'
+        assert 0 < remaining <= ttl
+
+        assert await store.get('missing') is None
+        assert await store.ttl('missing') is None
+        assert await store.get_with_ttl('missing') is None
+
+    run(main())
+
+
+def test_sqlite_store_survives_reopening(store, tmp_path):
+    run(store.set('key', b'value', ttl=60000))
+
+    reopened = SQLiteShareStore(str(tmp_path / 'shares.sqlite3'))
+    try:
+        assert run(reopened.get('key')) == b'value'
+    finally:
+        run(reopened.close())
+
+
+def test_sqlite_store_expires(store):
+    async def main():
+        await store.set('key', b'value', ttl=50)
+        await asyncio.sleep(0.1)
+        assert await store.get('key') is None
+        assert await store.ttl('key') is None
+        assert await store.get_with_ttl('key') is None
+
+    run(main())
+
+
+def test_share_cache_reads_through_and_expires(store):
+    data = {'layers': {'a': {'index': 0, 'url': 'colours/adults/body/large/a'}}, 'enabled': ['a']}
+    canonical = canonicalize(data)
+    new_id = share_id(canonical)
+
+    async def main():
+        cache = ShareCache(store, ttl=60, max_size=1024 * 1024)
+        assert await cache.get(new_id) is None
+
+        await store.set(share_key(new_id), encode_share(canonical), ttl=100)
+        assert await cache.get(new_id) == data
+        assert await cache.get(new_id) == data
+        assert cache.stats()['hits'] == 1
+
+        # Cached shares never outlive the share in the store
+        await asyncio.sleep(0.15)
+        assert await cache.get(new_id) is None
+        assert cache.stats()['expired'] == 1
+
+    run(main())
@@ -1,5 +1,6 @@
 import sys
 sys.path.insert(0, '/home/shay/horsereality-python')
+import asyncio
 import json
 import traceback
 from urllib.parse import urlparse
@@ -11,11 +12,18 @@ from redis import asyncio as aioredis
 
 import sanic
 from sanic import response as r
-from sanic.exceptions import SanicException
 
 from api import api, api_reroute, api_default
+from api.v2.cache import LRUCache
+from api.v2.engine import CompositingEngine
+from api.v2.errors import error_info
+from api.v2.layer_index import LayerIndex
+from api.v2.layers import LayerFetcher, LayerStore
+from api.v2.shares import RedisShareStore, SQLiteShareStore, ShareCache
+from api.v2 import render
 
 import horsereality
+import predictor
 
 config = json.load(open('config.json'))
 debug: bool = config.get('debug', False)
@@ -60,8 +68,9 @@ def cors_headers(request: sanic.Request) -> dict:
     origin = request.headers.get('Origin')
     if request.app.ctx.origin_allowed_cors(origin):
         return {
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
             'Access-Control-Allow-Origin': origin,
+            'Access-Control-Expose-Headers': 'ETag, X-Color-Info, X-Horse-Lifenumber, X-Merged-Image',
         }
 
     return {}
@@ -71,6 +80,19 @@ app.ctx.cors_headers = cors_headers
 
 @app.listener('after_server_start')
 async def server_init(app: sanic.Sanic, _):
+    # The process engine forks its workers straight away, which has to happen
+    # before anything below starts a thread
+    render_config = config.get('render', {})
+    decoded_cache_size = render_config.get('decoded_cache_size_mb', 512) * 1024 * 1024
+    prefix_cache_size = render_config.get('prefix_cache_size_mb', 256) * 1024 * 1024
+    render.configure(decoded_cache_size=decoded_cache_size, prefix_cache_size=prefix_cache_size)
+    app.ctx.engine = CompositingEngine(
+        render_config.get('engine', 'thread'),
+        workers=render_config.get('workers'),
+        decoded_cache_size=decoded_cache_size,
+        prefix_cache_size=prefix_cache_size,
+    )
+
     # For v1
     app.ctx.session = aiohttp.ClientSession()
 
@@ -83,48 +105,76 @@ async def server_init(app: sanic.Sanic, _):
     else:
         app.ctx.redis = None
 
+    shares_config = config.get('shares', {})
+    shares_backend = shares_config.get('backend', 'redis' if app.ctx.redis is not None else 'sqlite')
+    if shares_backend == 'redis':
+        app.ctx.share_store = RedisShareStore(app.ctx.redis) if app.ctx.redis is not None else None
+    elif shares_backend == 'sqlite':
+        app.ctx.share_store = SQLiteShareStore(shares_config.get('path', 'shares.sqlite3'))
+    elif shares_backend == 'none':
+        app.ctx.share_store = None
+    else:
+        raise ValueError(f'Unknown share backend {shares_backend!r}. Must be one of redis, sqlite, none.')
+
+    share_cache_size = shares_config.get('cache_size_mb', 16) * 1024 * 1024
+    if app.ctx.share_store is not None and share_cache_size > 0:
+        app.ctx.share_cache = ShareCache(
+            app.ctx.share_store,
+            ttl=shares_config.get('cache_ttl', 60),
+            max_size=share_cache_size,
+        )
+    else:
+        app.ctx.share_cache = None
+
     app.ctx.psql_pool = await asyncpg.create_pool(**config['postgres'])
+    async with app.ctx.psql_pool.acquire() as connection:
+        applied = await predictor.migrate(connection)
+    if applied:
+        logger.info(f'Applied schema migrations {applied}')
+
+    layer_index_config = config.get('layer_index', {})
+    if layer_index_config.get('enabled', True):
+        app.ctx.layer_index = LayerIndex(
+            app.ctx.psql_pool,
+            channel=layer_index_config.get('channel', 'realtools_layers'),
+            refresh_interval=layer_index_config.get('refresh_interval', 300),
+        )
+        await app.ctx.layer_index.start()
+    else:
+        app.ctx.layer_index = None
+
+    result_cache_size = render_config.get('result_cache_size_mb', 128) * 1024 * 1024
+    app.ctx.merge_results = LRUCache(result_cache_size) if result_cache_size > 0 else None
+    app.ctx.bulk_semaphore = asyncio.Semaphore(render_config.get('bulk_concurrency', 4))
+
+    layers_config = config.get('layers', {})
+    layer_cache_size = layers_config.get('cache_size_mb', 256) * 1024 * 1024
+    app.ctx.layer_fetcher = LayerFetcher(
+        concurrency=layers_config.get('fetch_concurrency', 32),
+        request_concurrency=layers_config.get('request_fetch_concurrency', 8),
+        cache=LRUCache(layer_cache_size) if layer_cache_size > 0 else None,
+        store=LayerStore(
+            layers_config['store_path'],
+            layers_config.get('store_size_mb', 2048) * 1024 * 1024,
+            max_maps=layers_config.get('store_max_maps', 256),
+        ) if layers_config.get('store_path') else None,
+    )
 
-# This dict intentionally skips a number of error
-# codes that Realtools would never raise
-status_code_dict = {
-    400: 'Bad Request',
-    401: 'Unauthorized',
-    403: 'Forbidden',
-    404: 'Not Found',
-    405: 'Method Not Allowed',
-    408: 'Request Timeout',
-    413: 'Payload Too Large',
-    429: 'Too Many Requests',
-    500: 'Internal Server Error',
-    501: 'Not Implemented',
-    502: 'Bad Gateway',
-    503: 'Service Unavailable',
-    504: 'Gateway Timeout',
-}
+@app.listener('before_server_stop')
+async def server_shutdown(app: sanic.Sanic, _):
+    app.ctx.engine.shutdown()
+    if app.ctx.share_store is not None:
+        await app.ctx.share_store.close()
+    if app.ctx.layer_index is not None:
+        await app.ctx.layer_index.close()
 
 @app.exception(Exception)
 async def error_handler(request: sanic.Request, exception: BaseException):
-    status_code = getattr(exception, 'status_code', getattr(exception, 'status', 500))
-    error_name = None
-    error_message = status_code_dict.get(status_code, 'Internal Server Error')
-
-    if status_code == 500:
-        traceback.print_exc()
-        logger.error(traceback.format_exc())
-
-    if isinstance(exception, horsereality.HorseRealityException):
-        error_message = exception.message
+    error = error_info(exception)
+    if error['status'] == 500:
+        traceback.print_exception(type(exception), exception, exception.__traceback__)
 
-    elif isinstance(exception, SanicException):
-        error_message = str(exception)
-        error_name = (exception.extra or {}).get('name')
-
-    return r.json(
-        {'status': status_code, 'message': error_message, 'name': error_name},
-        status=status_code,
-        headers=request.app.ctx.cors_headers(request),
-    )
+    return r.json(error, status=error['status'], headers=request.app.ctx.cors_headers(request))
 
 run_address = config.get('address', 'localhost')
 run_port = config.get('port', 2965)